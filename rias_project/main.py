@@ -285,8 +285,14 @@ def main():
     print("Stages: [01+06](Par) → [03](Seq) → [04](Seq) → [08+07](Seq) → [03b Merge](Final)")
     print("ALL RESULTS SAVED IN: ./results/<random_session>/\n")
 
+    # --batch: LLM steps go through the Batch API (half the price, results within 24h; for offline runs)
+    if "--batch" in sys.argv:
+        sys.argv.remove("--batch")
+        os.environ["RIAS_USE_BATCH_API"] = "1"
+        print("Batch API mode: LLM requests are queued as batch jobs.")
+
     if len(sys.argv) < 2:
-        print("Usage:\n  python main.py <folder_path> [limit]\n  python main.py <file.pdf>")
+        print("Usage:\n  python main.py <folder_path> [limit] [--batch]\n  python main.py <file.pdf> [--batch]")
         sys.exit(1)
     input_path = Path(sys.argv[1]); limit = None
     if not input_path.exists(): print(f"Error: Path not found: {input_path}"); sys.exit(1)
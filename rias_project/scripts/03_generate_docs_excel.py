@@ -1,31 +1,20 @@
 import json
-import sys
 import datetime
 import time
 from pathlib import Path
 from dotenv import load_dotenv
 from openai import OpenAI
 import pandas as pd
-from openpyxl import load_workbook
+from openpyxl.xml import LXML
+from utils import (
+    split_prompt, read_template_layout, new_write_only_workbook, add_layout_sheet,
+    LLMResponseCache, cacheable_temperature, get_logger, attach_log_file, json_loads, rate_limit_gate, retry_delay, shared_openai_http_client, strip_json_fence, read_prompt, read_truncated,
+)
 # Removed glob and os imports as locking is removed
 
-# ----------------------------------------------------------------------
-# Utility: Dual output logging (console + file)
-# ----------------------------------------------------------------------
-class Tee:
-    """Redirect stdout/stderr to both terminal and a log file."""
-
-    def __init__(self, *files):
-        self.files = files
+logger = get_logger("rias.compare")
 
-    def write(self, obj):
-        for f in self.files:
-            f.write(obj)
-            f.flush()
-
-    def flush(self):
-        for f in self.files:
-            f.flush()
+COMPARE_SYSTEM_PROMPT = "You are a research paper analyst. Return ONLY valid JSON following the given schema."
 
 
 # ----------------------------------------------------------------------
@@ -41,10 +30,12 @@ class DocsExcelGenerator:
         prompt_path: Path,
         template_path: Path,
         output_xlsx_path: Path, # Takes the specific output file path now
-        model: str = "gpt-4o",
+        model: str = "gpt-4o-mini",
         max_tokens: int = 10000,
         temperature: float = 0.0,
         max_retries: int = 3,
+        text_limit: int = 25_000,
+        enable_cache: bool = True,
     ):
         load_dotenv()
         self.prompt_path = Path(prompt_path)
@@ -55,9 +46,27 @@ class DocsExcelGenerator:
         self.max_tokens = max_tokens
         self.temperature = temperature
         self.max_retries = max_retries
+        self.text_limit = text_limit
+        # One pooled client per generator; call_llm does its own retries
+        self.client = OpenAI(http_client=shared_openai_http_client(), max_retries=0)
+        # Re-runs on an unchanged paper reuse the stored reply (only for near-deterministic sampling)
+        self.cache = LLMResponseCache(
+            Path(__file__).resolve().parent.parent / ".llm_cache" / "compare",
+            enabled=enable_cache and cacheable_temperature(temperature),
+        )
 
         self.output_dir.mkdir(parents=True, exist_ok=True)
 
+        # Read the template layout once; every write reuses it
+        self._template_layout = read_template_layout(self.template_path)
+        headers = {
+            sheet["title"]: list(sheet["rows"][0]) if sheet["rows"] else []
+            for sheet in self._template_layout
+        }
+        # Shared zero-row frames for papers with nothing to report (never mutated)
+        self._empty_overview = pd.DataFrame(columns=headers.get("Overview", []))
+        self._empty_results = pd.DataFrame(columns=headers.get("Results", []))
+
         # Setup logging directory relative to the output file's location
         timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
         try:
@@ -73,69 +82,59 @@ class DocsExcelGenerator:
         self.log_dir.mkdir(parents=True, exist_ok=True)
         self.log_file = self.log_dir / f"compare_log_{self.output_xlsx.stem}_{timestamp}.txt"
         self._init_logging()
-        print(f"📄 Logs will be saved to: {self.log_file}")
+        logger.info(f"📄 Logs will be saved to: {self.log_file}")
+        if not LXML:
+            logger.warning("⚠️ lxml not available to openpyxl; write-only mode falls back to the slower stdlib XML writer.")
 
     # ------------------------------------------------------------------
     def _init_logging(self):
-        log_f = open(self.log_file, "w", encoding="utf-8")
-        # Ensure we don't capture logs from parallel runs if Tee is already set
-        if not isinstance(sys.stdout, Tee):
-            sys.stdout = Tee(sys.__stdout__, log_f)
-            sys.stderr = Tee(sys.__stderr__, log_f)
-        else:
-             # If Tee is already active, just add our log file to it if not present
-             if log_f not in sys.stdout.files:
-                 sys.stdout.files += (log_f,)
-             if log_f not in sys.stderr.files:
-                 sys.stderr.files += (log_f,)
+        # Replaces the previous paper's log file instead of piling files onto a global stdout Tee
+        attach_log_file(logger, self.log_file)
 
 
     # ------------------------------------------------------------------
     # Utility functions (Unchanged from previous versions)
     # ------------------------------------------------------------------
-    @staticmethod
-    def truncate_text(text: str, limit: int = 25_000) -> str:
-        return text if len(text) <= limit else text[:limit] + "\n\n[Text truncated for LLM]"
-
     def load_prompt(self) -> str:
-        return self.prompt_path.read_text(encoding="utf-8")
+        return read_prompt(self.prompt_path) # Cached per process until the file changes
 
     @staticmethod
     def clean_raw(raw: str) -> str:
-        if raw.startswith("```"):
-            parts = raw.split("```", 2)
-            raw = parts[1] if len(parts) > 2 else parts[0]
-        raw = raw.strip()
-        if raw.lower().startswith("json"):
-            raw = raw[4:].strip()
-        return raw
+        return strip_json_fence(raw)
 
     # ------------------------------------------------------------------
     # LLM communication (Unchanged from previous versions)
     # ------------------------------------------------------------------
     def call_llm(self, prompt_text: str) -> str:
         """Send prompt to OpenAI model and return response."""
-        client = OpenAI()
         messages = [
-            {"role": "system", "content": "You are a research paper analyst. Return ONLY valid JSON following the given schema."},
+            {"role": "system", "content": COMPARE_SYSTEM_PROMPT},
             {"role": "user", "content": prompt_text},
         ]
+        key = LLMResponseCache.key(self.model, self.max_tokens, self.temperature, COMPARE_SYSTEM_PROMPT, prompt_text)
+        cached = self.cache.get(key)
+        if cached is not None:
+            logger.info("Using cached LLM response.")
+            return cached
 
         for attempt in range(self.max_retries):
             try:
-                resp = client.chat.completions.create(
+                rate_limit_gate().wait() # Near the rate limit: wait for the window instead of a 429
+                resp = self.client.chat.completions.create(
                     model=self.model,
                     messages=messages,
                     max_tokens=self.max_tokens,
                     temperature=self.temperature,
                     response_format={"type": "json_object"},
                 )
-                return resp.choices[0].message.content.strip()
+                content = resp.choices[0].message.content.strip()
+                self.cache.put(key, content)
+                return content
             except Exception as e:
-                print(f"⚠️ Attempt {attempt + 1} failed: {e}")
+                logger.warning(f"⚠️ Attempt {attempt + 1} failed: {e}")
                 if attempt == self.max_retries - 1:
                     raise
-                time.sleep(2 ** attempt)
+                time.sleep(retry_delay(e, attempt))
         return ""
 
     # ------------------------------------------------------------------
@@ -143,17 +142,24 @@ class DocsExcelGenerator:
     # ------------------------------------------------------------------
     def process_single_paper(self, txt_path: Path, paper_id: str, prompt_base: str):
         """Run LLM extraction for one paper and return two DataFrames."""
-        print(f"\n📘 Processing {txt_path.name} ({paper_id}) for individual comparison")
-        full_text = txt_path.read_text(encoding="utf-8")
-        combined_prompt = prompt_base.replace("<<<DOCUMENT_TEXT>>>", self.truncate_text(full_text))
+        logger.info(f"\n📘 Processing {txt_path.name} ({paper_id}) for individual comparison")
+        paper_text = read_truncated(txt_path, self.text_limit) # Only the part sent to the LLM is read
+        # Static instructions first, paper text last, so the prefix stays cacheable
+        prefix, suffix = split_prompt(prompt_base)
+        combined_prompt = prefix + paper_text + suffix
         raw = self.call_llm(combined_prompt)
-        cleaned = self.clean_raw(raw)
 
         try:
-            data = json.loads(cleaned)
-            print(f"✅ JSON parsed successfully for {txt_path.name}")
-            overview_df = pd.DataFrame(data.get("Overview", []))
-            results_df = pd.DataFrame(data.get("Results", []))
+            # JSON mode replies are bare JSON, so fences are only stripped if the reply does not parse as-is
+            try:
+                data = json_loads(raw) # orjson when installed
+            except json.JSONDecodeError:
+                data = json_loads(self.clean_raw(raw))
+            logger.info(f"✅ JSON parsed successfully for {txt_path.name}")
+            overview_rows = data.get("Overview", [])
+            results_rows = data.get("Results", [])
+            overview_df = pd.DataFrame(overview_rows) if overview_rows else self._empty_overview
+            results_df = pd.DataFrame(results_rows) if results_rows else self._empty_results
 
             # Ensure PaperID uses the actual file stem
             if not overview_df.empty:
@@ -163,43 +169,43 @@ class DocsExcelGenerator:
 
             return overview_df, results_df
         except json.JSONDecodeError as e:
-            print(f"❌ JSON parsing failed for {txt_path.name}: {e}")
-            return pd.DataFrame(), pd.DataFrame()
+            logger.error(f"❌ JSON parsing failed for {txt_path.name}: {e}")
+            return self._empty_overview, self._empty_results
 
     # ------------------------------------------------------------------
-    # Write to Excel template (Unchanged logic, clears placeholders)
+    # Write to Excel template (write-only, rebuilt from the template layout)
     # ------------------------------------------------------------------
     def write_to_template(self, overview_df: pd.DataFrame, results_df: pd.DataFrame):
-        """Insert dataframes into a *copy* of the Excel template and save."""
-        print(f"\n🧾 Writing results for one paper to {self.output_xlsx.name}...")
-        # Load a fresh copy of the template each time
-        wb = load_workbook(self.template_path)
-
-        if "Overview" in wb.sheetnames:
-            ws = wb["Overview"]
-            headers = [cell.value for cell in ws[1]]
-            ws.delete_rows(2, ws.max_row) # Clear placeholders
-            for _, row in overview_df.iterrows():
-                ws.append([row.get(h, "") for h in headers])
-            print(f"✅ Overview sheet: {len(overview_df)} entries written.")
-
-        if "Results" in wb.sheetnames:
-            ws = wb["Results"]
-            headers = [cell.value for cell in ws[1]]
-            ws.delete_rows(2, ws.max_row) # Clear placeholders
-            for _, row in results_df.iterrows():
-                ws.append([row.get(h, "") for h in headers])
-            print(f"✅ Results sheet: {len(results_df)} entries written.")
+        """Stream dataframes into a write-only workbook that mirrors the Excel template."""
+        logger.info(f"\n🧾 Writing results for one paper to {self.output_xlsx.name}...")
+        wb = new_write_only_workbook()
+        data_sheets = {"Overview": overview_df, "Results": results_df}
+
+        for sheet in self._template_layout:
+            ws, headers = add_layout_sheet(wb, sheet)
+            df = data_sheets.get(sheet["title"])
+            if df is None:
+                # Static sheets (e.g. Legend) are copied verbatim
+                for row in sheet["rows"][1:]:
+                    ws.append(row)
+                continue
+
+            # Placeholder rows from the template are dropped; body rows are raw tuples
+            # Columns are aligned once with reindex, then rows come out of itertuples as plain tuples
+            body = df.reindex(columns=headers, fill_value="")
+            for row in body.itertuples(index=False, name=None):
+                ws.append(row)
+            logger.info(f"✅ {sheet['title']} sheet: {len(df)} entries written.")
 
         wb.save(self.output_xlsx)
-        print(f"💾 Individual comparison Excel saved to: {self.output_xlsx}")
+        logger.info(f"💾 Individual comparison Excel saved to: {self.output_xlsx}")
 
     # ------------------------------------------------------------------
     # Main execution method for a SINGLE file comparison
     # ------------------------------------------------------------------
     def run_single_comparison(self, txt_file: Path):
         """ Processes ONE txt file and saves its comparison Excel."""
-        print(f"\n--- Starting comparison for {txt_file.name} ---")
+        logger.info(f"\n--- Starting comparison for {txt_file.name} ---")
 
         prompt_base = self.load_prompt()
         paper_id = txt_file.stem # Use file stem (e.g., 'test3')
@@ -207,13 +213,11 @@ class DocsExcelGenerator:
         overview_df, results_df = self.process_single_paper(txt_file, paper_id, prompt_base)
 
         if overview_df.empty and results_df.empty:
-            print(f"⚠️ No valid data extracted from {txt_file.name}.")
-            # Save an empty file based on the template for consistency
-            self.write_to_template(pd.DataFrame(), pd.DataFrame())
-        else:
-            self.write_to_template(overview_df, results_df)
+            logger.warning(f"⚠️ No valid data extracted from {txt_file.name}.")
+        # Empty results still produce a file based on the template for consistency
+        self.write_to_template(overview_df, results_df)
 
-        print(f"\n✅ Comparison for {txt_file.name} finished!")
+        logger.info(f"\n✅ Comparison for {txt_file.name} finished!")
 
 
 # ------------------------------------------------------------------
@@ -229,7 +233,7 @@ def run(pdf_path, out_dir, prev=None):
         p_out_dir = Path(out_dir)
         pdf_stem = p_pdf.stem
 
-        print(f"--- Running Step 03: Compare Papers for {pdf_stem} ---")
+        logger.info(f"--- Running Step 03: Compare Papers for {pdf_stem} ---")
 
         # 1. Find the corresponding input .txt file from step 01
         # Assumes step 01 output is in '<proc_dir>/01_.../*.txt' relative to out_dir
@@ -246,6 +250,7 @@ def run(pdf_path, out_dir, prev=None):
         # 3. Get project paths for template and prompt
         SCRIPT_DIR = Path(__file__).resolve().parent
         PROJECT_ROOT = SCRIPT_DIR.parent
+        # Same template as the merge step; only its header, widths and static sheets are read
         template_file = PROJECT_ROOT / "templates" / "Paper_Comparison_Template.xlsx"
         prompt_file = PROJECT_ROOT / "prompts" / "[Prompt]compare_prompt.txt"
 
@@ -271,16 +276,15 @@ def run(pdf_path, out_dir, prev=None):
 
     except Exception as e:
         import traceback
-        print(f"ERROR in 03_generate_docs_excel for {pdf_path.stem if pdf_path else 'unknown'}: {e}")
-        traceback.print_exc()
+        logger.error(f"ERROR in 03_generate_docs_excel for {Path(pdf_path).stem if pdf_path else 'unknown'}: {e}\n{traceback.format_exc()}")
         return {"status": "error", "error": str(e)}
 
 # ----------------------------------------------------------------------
 # Optional: CLI entry point (if needed for direct testing of single file)
 # ----------------------------------------------------------------------
 if __name__ == "__main__":
-    print("This script is designed to be run via the main pipeline.")
-    print("For direct testing, you would need to provide specific paths.")
+    logger.info("This script is designed to be run via the main pipeline.")
+    logger.info("For direct testing, you would need to provide specific paths.")
     # Example (modify paths as needed):
     # test_pdf_path = Path("../results/some_session/test3/raw/test3.pdf")
     # test_out_dir = Path("../results/some_session/test3/processed/03_compare_papers_output")
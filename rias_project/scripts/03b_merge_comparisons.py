@@ -1,31 +1,34 @@
 import sys
+import hashlib
 import datetime
+from collections import deque
 from pathlib import Path
 import pandas as pd
-from openpyxl import load_workbook
-import time
 import os
 import argparse # Import argparse for command-line arguments
-
-# ----------------------------------------------------------------------
-# Utility: Dual output logging (console + file)
-# ----------------------------------------------------------------------
-class Tee:
-    """Redirect stdout/stderr to both terminal and a log file."""
-    def __init__(self, *files):
-        self.files = files
-    def write(self, obj):
-        for f in self.files:
-            try: # Add basic error handling for logging
-                f.write(obj); f.flush()
-            except Exception as e:
-                print(f"Error writing to log {getattr(f, 'name', 'unknown')}: {e}", file=sys.__stderr__)
-    def flush(self):
-        for f in self.files:
-            try:
-                 f.flush()
-            except Exception:
-                 pass # Ignore flush errors
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from utils import read_template_layout, new_write_only_workbook, add_layout_sheet, get_logger, attach_log_file, json_loads, json_dumps_pretty
+
+# Prefer the Rust-backed calamine reader for .xlsx; fall back to pandas' default (openpyxl)
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_READ_ENGINE = "calamine"
+except ImportError:
+    EXCEL_READ_ENGINE = None
+
+logger = get_logger("rias.merge")
+
+
+def _bounded_map(ex, fn, items, window: int):
+    """Like ex.map (results in order), but at most `window` calls are submitted ahead of the consumer."""
+    pending = deque()
+    for item in items:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(ex.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
 
 # ----------------------------------------------------------------------
 # Core Merger Class
@@ -38,6 +41,10 @@ class ComparisonMerger:
         self.template_path = template_path
         self.output_xlsx = self.session_root / "03_comparison_merged.xlsx"
         self.individual_files_pattern_relative = "*/processed/03_compare_papers_output/*_comparison.xlsx"
+        self._individual_files = None # Cached result of find_individual_files
+        # Frames of unchanged files are reused across re-runs, keyed by (mtime_ns, size)
+        self.manifest_path = self.session_root / ".merge_manifest.json"
+        self.frame_cache_dir = self.session_root / ".merge_cache"
 
         # Setup logging
         timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
@@ -46,134 +53,216 @@ class ComparisonMerger:
         self.log_file = self.log_dir / f"merge_compare_log_{timestamp}.txt"
         # Defer logger initialization until needed, avoid issues if run multiple times
         self._logger_initialized = False
-        print(f"📄 Merge logs *will* be saved to: {self.log_file}") # Indicate intent
+        logger.info(f"📄 Merge logs *will* be saved to: {self.log_file}") # Indicate intent
 
     def _ensure_logging(self):
-        """Initializes Tee logger if not already done."""
+        """Attach this merge's log file to the module logger (once, from run_merge, the single entry point)."""
         if self._logger_initialized:
             return
         try:
-            log_f = open(self.log_file, "w", encoding="utf-8")
-            # Only replace if not already Tee, otherwise add file
-            if not isinstance(sys.stdout, Tee):
-                print("(Merge Step) Initializing Tee logger.")
-                # Store originals only if we are the first to replace
-                if not hasattr(sys, '_original_stdout'): sys._original_stdout = sys.stdout
-                if not hasattr(sys, '_original_stderr'): sys._original_stderr = sys.stderr
-                sys.stdout = Tee(sys.__stdout__, log_f)
-                sys.stderr = Tee(sys.__stderr__, log_f)
-            else:
-                print("(Merge Step) Adding log file to existing Tee.")
-                if log_f not in sys.stdout.files: sys.stdout.files = sys.stdout.files + (log_f,)
-                if log_f not in sys.stderr.files: sys.stderr.files = sys.stderr.files + (log_f,)
+            attach_log_file(logger, self.log_file)
             self._logger_initialized = True
         except Exception as e:
-            print(f"Error initializing logging: {e}", file=sys.__stderr__)
+            logger.error(f"Error initializing logging: {e}")
 
 
     def find_individual_files(self) -> list:
-        """Find all individual comparison files within the session using pathlib.rglob."""
-        self._ensure_logging() # Ensure logging is active
-        print(f"Searching recursively within {self.session_root} for files matching: '{self.individual_files_pattern_relative}'")
-        files = list(self.session_root.rglob(self.individual_files_pattern_relative))
-        print(f"Found {len(files)} individual comparison files to merge:")
+        """Find all individual comparison files within the session (fixed depth, cached per merger)."""
+        if self._individual_files is not None:
+            return self._individual_files
+        logger.info(f"Searching within {self.session_root} for files matching: '{self.individual_files_pattern_relative}'")
+        # The pattern has a fixed depth, so glob avoids walking unrelated subtrees (logs/, images, ...)
+        files = list(self.session_root.glob(self.individual_files_pattern_relative))
+        logger.info(f"Found {len(files)} individual comparison files to merge:")
         files.sort()
         for f in files:
-            try: print(f"  - {f.relative_to(self.session_root)}")
-            except ValueError: print(f"  - {f}")
+            try: logger.info(f"  - {f.relative_to(self.session_root)}")
+            except ValueError: logger.info(f"  - {f}")
+        self._individual_files = files
         return files
 
-    def read_data_from_excel(self, file_path: Path) -> (pd.DataFrame, pd.DataFrame):
-        self._ensure_logging() # Ensure logging is active
-        print(f"Reading data from: {file_path.name}")
+    @staticmethod
+    def _read_openpyxl_readonly(path: Path, sheets: tuple) -> list:
+        """Read sheets (first row = headers) via a read-only openpyxl workbook, without a full DOM."""
+        from openpyxl import load_workbook
+        wb = load_workbook(path, read_only=True, data_only=True, keep_links=False)
         try:
-            overview_df = pd.read_excel(file_path, sheet_name="Overview", header=0)
-            results_df = pd.read_excel(file_path, sheet_name="Results", header=0)
-            print(f"  -> Read {len(overview_df)} overview rows, {len(results_df)} results rows.")
-            return overview_df, results_df
+            frames = []
+            for sheet in sheets:
+                if sheet not in wb.sheetnames:
+                    raise ValueError(f"Worksheet named '{sheet}' not found")
+                rows = wb[sheet].values
+                headers = next(rows, None)
+                if headers is None:
+                    frames.append(pd.DataFrame())
+                    continue
+                # Blank header cells (under stray data further right) are named as pd.read_excel names them
+                headers = [f"Unnamed: {i}" if h is None else h for i, h in enumerate(headers)]
+                # Rows can be wider (stray cells past the last header) or narrower than the header row;
+                # fit each to it, then drop blank rows left behind by formatting, as pd.read_excel does
+                width = len(headers)
+                fill = (None,) * width
+                data = [r for r in ((row + fill)[:width] for row in rows) if any(v is not None for v in r)]
+                frames.append(pd.DataFrame(data, columns=headers))
+            return frames
+        finally:
+            wb.close() # Release the underlying zip handle
+
+    def read_data_from_excel(self, file_path: Path) -> (pd.DataFrame, pd.DataFrame, bool):
+        """(overview_df, results_df, failed); a failed read gives empty frames that must not be cached."""
+        messages = [f"Reading data from: {file_path.name}"]
+        try:
+            if EXCEL_READ_ENGINE == "calamine":
+                # Open the workbook once and parse both sheets from the same container
+                with pd.ExcelFile(file_path, engine=EXCEL_READ_ENGINE) as xf:
+                    overview_df = xf.parse("Overview", header=0)
+                    results_df = xf.parse("Results", header=0)
+            else:
+                overview_df, results_df = self._read_openpyxl_readonly(file_path, ("Overview", "Results"))
+            messages.append(f"  -> Read {len(overview_df)} overview rows, {len(results_df)} results rows.")
+            return overview_df, results_df, False
         except ValueError as ve:
-             print(f"⚠️ Sheet missing or other read error in {file_path.name}: {ve}")
-             return pd.DataFrame(), pd.DataFrame()
+             messages.append(f"⚠️ Sheet missing or other read error in {file_path.name}: {ve}")
+             return pd.DataFrame(), pd.DataFrame(), True
         except Exception as e:
-            print(f"⚠️ Failed to read data from {file_path.name}: {e}")
-            return pd.DataFrame(), pd.DataFrame()
+            messages.append(f"⚠️ Failed to read data from {file_path.name}: {e}")
+            return pd.DataFrame(), pd.DataFrame(), True
+        finally:
+            logger.info("\n".join(messages)) # One record per file, so parallel reads don't interleave
+
+    def _load_manifest(self) -> dict:
+        try:
+            return json_loads(self.manifest_path.read_bytes())
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save_manifest(self, manifest: dict) -> None:
+        tmp = self.manifest_path.with_suffix(".json.tmp")
+        tmp.write_bytes(json_dumps_pretty(manifest))
+        os.replace(tmp, self.manifest_path) # Atomic swap so a crash never leaves half a manifest
+
+    def _read_cached(self, file_path: Path, manifest: dict, new_manifest: dict):
+        """Return the file's frames from the cache if mtime/size are unchanged, else re-read it."""
+        rel = file_path.relative_to(self.session_root).as_posix()
+        st = file_path.stat()
+        stamp = [st.st_mtime_ns, st.st_size]
+        cache_file = self.frame_cache_dir / f"{hashlib.blake2b(rel.encode(), digest_size=8).hexdigest()}.pkl"
+
+        if manifest.get(rel) == stamp and cache_file.exists():
+            try:
+                overview_df, results_df = pd.read_pickle(cache_file)
+                logger.info(f"Reusing cached data for: {file_path.name} (unchanged)")
+                new_manifest[rel] = stamp
+                return overview_df, results_df
+            except Exception as e:
+                logger.warning(f"⚠️ Cache entry for {file_path.name} unreadable ({e}); re-reading.")
 
-    def write_merged_to_template(self, overview_df: pd.DataFrame, results_df: pd.DataFrame):
-        self._ensure_logging() # Ensure logging is active
-        print(f"\n🧾 Writing merged data ({len(overview_df)} overview, {len(results_df)} results) to {self.output_xlsx.name}...")
+        overview_df, results_df, failed = self.read_data_from_excel(file_path)
+        if failed:
+            return overview_df, results_df # Not cached: the next merge retries the file
+        try:
+            self.frame_cache_dir.mkdir(exist_ok=True)
+            pd.to_pickle((overview_df, results_df), cache_file)
+            new_manifest[rel] = stamp
+        except Exception as e:
+            logger.warning(f"⚠️ Could not cache data for {file_path.name}: {e}")
+        return overview_df, results_df
+
+    def _stream_sheet(self, ws, headers: list, df: pd.DataFrame) -> None:
+        """Append DataFrame rows to a write-only sheet in template header order."""
+        # Align columns to the headers once, then convert each column to native Python scalars
+        # in one pass (blanks -> '') so rows can be zipped together without itertuples overhead
+        aligned = df.reindex(columns=headers)
+        columns = []
+        for i in range(aligned.shape[1]):
+            col = aligned.iloc[:, i]
+            if col.dtype == object:
+                columns.append(col.fillna('').to_list())
+            else:
+                columns.append(col.astype(object).where(col.notna(), '').to_list())
+        errors = []
+        for idx, row in enumerate(zip(*columns)):
+            try: ws.append(row)
+            except Exception as row_err: errors.append((idx, str(row_err)))
+        # One summary line instead of a log write per failing row
+        if errors:
+            logger.warning(f"⚠️ {len(errors)} {ws.title} rows failed to append; first: {errors[:5]}")
+
+    def write_merged_to_template(self, frames) -> dict:
+        """
+        Stream (overview_df, results_df) pairs, one per individual file, straight into a
+        write-only copy of the template. Nothing is concatenated, so memory is bounded by
+        the frames the caller has produced but not yet handed over (see run_merge).
+        Returns the number of rows appended per data sheet.
+        """
+        logger.info(f"\n🧾 Writing merged data to {self.output_xlsx.name}...")
         try:
             # Check if template exists before loading
             if not self.template_path.exists():
                 raise FileNotFoundError(f"Template file not found at: {self.template_path}")
 
-            wb = load_workbook(self.template_path)
-            if "Overview" in wb.sheetnames:
-                ws = wb["Overview"]; headers = [c.value for c in ws[1]]
-                ws.delete_rows(2, ws.max_row) # Clear placeholders
-                overview_df_filled = overview_df.fillna('')
-                for idx, row in overview_df_filled.iterrows():
-                    try: ws.append([row.get(h, "") for h in headers])
-                    except Exception as row_err: print(f"   - Error appending overview row {idx}: {row_err}")
-                print(f"✅ Merged Overview sheet: Appended {len(overview_df)} entries.")
-            else: print("⚠️ 'Overview' sheet not found in template. Skipping.")
-
-            if "Results" in wb.sheetnames:
-                ws = wb["Results"]; headers = [c.value for c in ws[1]]
-                ws.delete_rows(2, ws.max_row) # Clear placeholders
-                results_df_filled = results_df.fillna('')
-                for idx, row in results_df_filled.iterrows():
-                     try: ws.append([row.get(h, "") for h in headers])
-                     except Exception as row_err: print(f"   - Error appending results row {idx}: {row_err}")
-                print(f"✅ Merged Results sheet: Appended {len(results_df)} entries.")
-            else: print("⚠️ 'Results' sheet not found in template. Skipping.")
+            # Only the template layout is read; every sheet is created up front (in template order)
+            # so each file's rows can be appended to Overview and Results as it arrives
+            layout = read_template_layout(self.template_path)
+            wb = new_write_only_workbook()
+            data_sheets = {}
+            for sheet in layout:
+                ws, headers = add_layout_sheet(wb, sheet)
+                if sheet["title"] in ("Overview", "Results"):
+                    data_sheets[sheet["title"]] = (ws, headers)
+                else:
+                    for row in sheet["rows"][1:]: ws.append(row) # Static sheets (e.g. Legend)
+            for name in ("Overview", "Results"):
+                if name not in data_sheets:
+                    logger.warning(f"⚠️ '{name}' sheet not found in template. Skipping.")
+
+            counts = {"Overview": 0, "Results": 0}
+            for overview_df, results_df in frames:
+                for name, df in (("Overview", overview_df), ("Results", results_df)):
+                    if name in data_sheets and not df.empty:
+                        self._stream_sheet(*data_sheets[name], df)
+                        counts[name] += len(df)
+            for name in data_sheets:
+                logger.info(f"✅ Merged {name} sheet: Appended {counts[name]} entries.")
 
             wb.save(self.output_xlsx)
-            print(f"💾 Merged comparison Excel saved to: {self.output_xlsx}")
+            logger.info(f"💾 Merged comparison Excel saved to: {self.output_xlsx}")
+            return counts
         except Exception as e:
-            print(f"❌ Failed to write merged Excel file: {e}"); raise
+            logger.error(f"❌ Failed to write merged Excel file: {e}"); raise
+
+    def _write_empty_merge(self):
+        """Save the template headers with no data rows."""
+        try: self.write_merged_to_template([])
+        except Exception as e: logger.error(f"❌ Failed to create empty merged file: {e}")
 
     def run_merge(self):
         """Main execution logic for merging."""
         self._ensure_logging() # Ensure logging is active for the whole process
-        print("\n--- Starting Comparison Merge Process ---")
+        logger.info("\n--- Starting Comparison Merge Process ---")
         individual_files = self.find_individual_files()
 
         if not individual_files:
-            print("⚠️ No individual comparison files found. Creating empty merge file.")
-            try:
-                if not self.template_path.exists(): raise FileNotFoundError("Template not found")
-                wb = load_workbook(self.template_path)
-                if "Overview" in wb.sheetnames: wb["Overview"].delete_rows(2, wb["Overview"].max_row)
-                if "Results" in wb.sheetnames: wb["Results"].delete_rows(2, wb["Results"].max_row)
-                wb.save(self.output_xlsx); print(f"💾 Empty merged file saved: {self.output_xlsx}")
-            except Exception as e: print(f"❌ Failed to create empty merged file: {e}")
+            logger.warning("⚠️ No individual comparison files found. Creating empty merge file.")
+            self._write_empty_merge()
             return
 
-        all_overview_dfs = []
-        all_results_dfs = []
-        for file_path in individual_files:
-            overview_df, results_df = self.read_data_from_excel(file_path)
-            if not overview_df.empty: all_overview_dfs.append(overview_df)
-            if not results_df.empty: all_results_dfs.append(results_df)
-
-        if not all_overview_dfs and not all_results_dfs:
-            print("⚠️ No valid data found in any individual file. Creating empty merge file.")
-            try:
-                if not self.template_path.exists(): raise FileNotFoundError("Template not found")
-                wb = load_workbook(self.template_path);
-                if "Overview" in wb.sheetnames: wb["Overview"].delete_rows(2, wb["Overview"].max_row)
-                if "Results" in wb.sheetnames: wb["Results"].delete_rows(2, wb["Results"].max_row)
-                wb.save(self.output_xlsx); print(f"💾 Empty merged file saved: {self.output_xlsx}")
-            except Exception as e: print(f"❌ Failed to create empty merged file: {e}")
-            return
-
-        print(f"Concatenating data from {len(individual_files)} files...")
-        combined_overview = pd.concat(all_overview_dfs, ignore_index=True) if all_overview_dfs else pd.DataFrame()
-        combined_results = pd.concat(all_results_dfs, ignore_index=True) if all_results_dfs else pd.DataFrame()
-        print(f"Total overview rows: {len(combined_overview)}, Total results rows: {len(combined_results)}")
-
-        self.write_merged_to_template(combined_overview, combined_results)
-        print("\n✅ Comparison merge finished successfully!")
+        # Reads are I/O and zip/XML bound, so a small thread pool overlaps them. Results come back in
+        # file order, and only a window of reads runs ahead of the writer, so finished frames
+        # don't pile up in memory
+        logger.info(f"Streaming data from {len(individual_files)} files...")
+        manifest, new_manifest = self._load_manifest(), {}
+        read = partial(self._read_cached, manifest=manifest, new_manifest=new_manifest)
+        max_workers = min(8, os.cpu_count() or 1, len(individual_files))
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            counts = self.write_merged_to_template(_bounded_map(ex, read, individual_files, 2 * max_workers))
+        try: self._save_manifest(new_manifest)
+        except Exception as e: logger.warning(f"⚠️ Could not update merge manifest: {e}")
+        logger.info(f"Total overview rows: {counts['Overview']}, Total results rows: {counts['Results']}")
+
+        if not any(counts.values()):
+            logger.warning("⚠️ No valid data found in any individual file. Merged file contains template headers only.")
+        logger.info("\n✅ Comparison merge finished successfully!")
 
 # ------------------------------------------------------------------
 # Bridge function for main.py pipeline - NO LOCK
@@ -191,7 +280,7 @@ def run(pdf_path, session_dir, prev_results=None):
         if not session_root.is_dir():
              raise NotADirectoryError(f"Provided session path is not a directory: {session_dir}")
 
-        print(f"--- Running Step 03b: Merge Comparisons for Session {session_root.name} ---")
+        logger.info(f"--- Running Step 03b: Merge Comparisons for Session {session_root.name} ---")
 
         # 1. Find the template file
         SCRIPT_DIR = Path(__file__).resolve().parent
@@ -213,10 +302,7 @@ def run(pdf_path, session_dir, prev_results=None):
 
     except Exception as e:
         import traceback
-        # Attempt to use logger if initialized, otherwise print directly
-        logger = sys.stderr if isinstance(sys.stderr, Tee) else sys.__stderr__
-        print(f"ERROR in 03b_merge_comparisons: {e}", file=logger)
-        traceback.print_exc(file=logger)
+        logger.error(f"ERROR in 03b_merge_comparisons: {e}\n{traceback.format_exc()}")
         return {"status": "error", "error": str(e)}
 
 # ----------------------------------------------------------------------
@@ -229,10 +315,10 @@ if __name__ == "__main__":
 
     session_dir_path = Path(args.session_directory).resolve() # Resolve to absolute path
 
-    print(f"Running merge script in standalone mode for session: {session_dir_path}")
+    logger.info(f"Running merge script in standalone mode for session: {session_dir_path}")
 
     if not session_dir_path.is_dir():
-        print(f"Error: Provided path is not a valid directory: {session_dir_path}")
+        logger.error(f"Error: Provided path is not a valid directory: {session_dir_path}")
         sys.exit(1)
 
     # Assume template is in default location relative to project root
@@ -240,14 +326,14 @@ if __name__ == "__main__":
         project_root = Path(__file__).resolve().parent.parent
         template_path = project_root / "templates" / "Paper_Comparison_Template.xlsx"
         if not template_path.exists():
-            print(f"Error: Template file not found at expected location: {template_path}")
+            logger.error(f"Error: Template file not found at expected location: {template_path}")
             # Try alternative location relative to session_dir? Unlikely structure.
             alt_template = session_dir_path.parent.parent / "templates" / "Paper_Comparison_Template.xlsx"
             if alt_template.exists():
-                 print(f"Using alternative template path: {alt_template}")
+                 logger.info(f"Using alternative template path: {alt_template}")
                  template_path = alt_template
             else:
-                 print("Cannot find template file.")
+                 logger.info("Cannot find template file.")
                  sys.exit(1)
 
         # Instantiate the merger directly for standalone run
@@ -255,11 +341,11 @@ if __name__ == "__main__":
         merger_instance.run_merge() # Call the main merge logic
 
     except Exception as e:
-        print(f"\nError during standalone merge test run: {e}")
+        logger.info(f"\nError during standalone merge test run: {e}")
         import traceback
         traceback.print_exc()
         sys.exit(1) # Exit with error code
 
-    print("\n--- Standalone merge script finished ---")
+    logger.info("\n--- Standalone merge script finished ---")
 
 # ----------------------------------------------------------------------
\ No newline at end of file
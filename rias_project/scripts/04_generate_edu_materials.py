@@ -1,33 +1,111 @@
 # edu_materials_generator.py
 import json
-import sys
+import asyncio
+import hashlib
+import os
+import time
 import datetime
+import io
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 from dotenv import load_dotenv
-from openai import OpenAI
-import time
-import pandas as pd
+from openai import AsyncOpenAI, OpenAI
 from pptx import Presentation
 from pptx.util import Inches
-from zipfile import ZipFile
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
 from typing import List, Dict, Any, Tuple, Optional
-
-
-# ----------------------------------------------------------------------
-# LOGGING SETUP — print to both console and log file
-# ----------------------------------------------------------------------
-class Tee:
-    def __init__(self, *files):
-        self.files = files
-
-    def write(self, obj):
-        for f in self.files:
-            f.write(obj)
-            f.flush()
-
-    def flush(self):
-        for f in self.files:
-            f.flush()
+from utils import (
+    AsyncTokenBucket, JsonArrayStream, LLMResponseCache, batch_api_enabled, cacheable_temperature, list_files, openai_http_client, read_prompt, read_truncated_tokens, count_tokens, shared_openai_http_client, split_prompt, strip_json_fence,
+    get_logger, attach_log_file, rate_limit_gate, retry_delay, json_loads, json_dumps, json_dumps_pretty,
+)
+
+
+logger = get_logger("rias.edu")
+
+EDU_SYSTEM_PROMPT = (
+    "You are an educational AI tutor that outputs structured JSON only. "
+    "If the paper has few metrics, you may generate example metrics for teaching, "
+    "but keep consistent JSON keys. "
+    "Never output markdown or commentary — JSON only."
+)
+
+# Static lab content, encoded once at import instead of per lab
+CSV_CONTENT_BYTES = b"x,y,true_label,pred_label\n1,0.8,1,1\n2,0.3,1,0\n3,0.9,0,1\n"
+CODE_IMPORTS_BYTES = b"import pandas as pd\nimport numpy as np\nimport matplotlib.pyplot as plt\n\n"
+
+
+# Lab members are a few hundred bytes of text; level 1 deflates them about as well as 6
+LAB_ZIP_LEVEL = 1
+
+
+def _zip_entry(name: str) -> ZipInfo:
+    """Archive member with a fixed timestamp and deflate, so lab zips are reproducible."""
+    info = ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+    info.compress_type = ZIP_DEFLATED
+    info.external_attr = 0o644 << 16
+    return info
+
+
+def _write_entry(zf: ZipFile, name: str, data: bytes) -> None:
+    # The ZipFile's own compresslevel only applies to members added by name, not as a ZipInfo
+    zf.writestr(_zip_entry(name), data, compresslevel=LAB_ZIP_LEVEL)
+
+
+@lru_cache(maxsize=1)
+def _blank_pptx_bytes() -> bytes:
+    """python-pptx's default template, read from package data once per process."""
+    buf = io.BytesIO()
+    Presentation().save(buf)
+    return buf.getvalue()
+
+
+class _StreamedOutputs:
+    """Slide deck and lab zip filled from a streamed reply as its Slides/Labs elements complete."""
+
+    def __init__(self, gen: "EducationalMaterialsGenerator"):
+        self._gen = gen
+        self._parser = JsonArrayStream(("Slides", "Labs"), self._on_item)
+        # Nothing is built until a request actually streams (a cached reply never does)
+        self.prs = self.layout = self.zf = None
+        self.slides = self.labs = 0
+        self.broken = False
+
+    def reset(self):
+        """Start over (called before each streamed request; a retry streams its reply again)."""
+        if self.zf is not None:
+            self.zf.close()
+        self._parser.reset()
+        self.prs, self.layout = self._gen._new_deck()
+        self.zip_buf = io.BytesIO()
+        self.zf = ZipFile(self.zip_buf, "w", ZIP_DEFLATED)
+        self.slides = self.labs = 0
+        self.broken = False
+
+    def feed(self, delta: str):
+        self._parser.feed(delta)
+
+    def _on_item(self, key: str, item):
+        if not isinstance(item, dict):
+            self.broken = True
+        elif key == "Slides":
+            self._gen._add_slide(self.prs, self.layout, item)
+            self.slides += 1
+        else:
+            self.labs += 1
+            self._gen._write_lab(self.zf, self.labs, item)
+
+    def matches(self, slides: List[Dict], labs: List[Dict]) -> bool:
+        """True if everything in the parsed reply was built here (not so for cached or repaired replies)."""
+        return self.zf is not None and not self.broken and self.slides == len(slides) and self.labs == len(labs)
+
+    def save(self, ppt_path: Optional[Path], zip_path: Optional[Path], raw_json_sample: Dict):
+        self.zf.close()
+        if ppt_path:
+            self._gen._save_ppt(self.prs, ppt_path, raw_json_sample)
+        if zip_path:
+            zip_path.write_bytes(self.zip_buf.getvalue())
+            logger.info(f"Lab files saved to {zip_path}")
 
 
 class EducationalMaterialsGenerator:
@@ -41,7 +119,16 @@ class EducationalMaterialsGenerator:
         max_tokens: int = 10000,
         temperature: float = 0.0,
         max_retries: int = 3,
-        text_limit: int = 20_000,
+        text_limit: int = 5_000,
+        context_window: int = 128_000,
+        max_concurrency: int = None,
+        enable_cache: bool = True,
+        use_batch: bool = False,
+        batch_poll_seconds: int = 30,
+        skip_unchanged: bool = True,
+        requests_per_minute: int = 500,
+        tokens_per_minute: int = 800_000,
+        stream_outputs: bool = False,
     ):
         # Setup paths
         self.SCRIPT_DIR = script_dir or Path(__file__).resolve().parent.parent
@@ -55,224 +142,433 @@ class EducationalMaterialsGenerator:
         self.MAX_TOKENS = max_tokens
         self.TEMPERATURE = temperature
         self.MAX_RETRIES = max_retries
-        self.TEXT_LIMIT = text_limit
+        self.TEXT_LIMIT = text_limit # Tokens of paper text sent to the LLM
+        self.CONTEXT_WINDOW = context_window
+        self.MAX_CONCURRENCY = max_concurrency or int(os.getenv("OPENAI_CONCURRENCY", "8"))
+        # Account rate limits (0 disables); pacing requests avoids 429 backoff storms at full concurrency
+        self.REQUESTS_PER_MINUTE = requests_per_minute
+        self.TOKENS_PER_MINUTE = tokens_per_minute
+        # Batch API: half the cost, results within the 24h window; for offline runs only
+        self.USE_BATCH = use_batch
+        self.BATCH_POLL_SECONDS = batch_poll_seconds
+        # Stream replies and add slides/labs as their elements complete, instead of after the whole reply
+        self.STREAM_OUTPUTS = stream_outputs
+        # Papers whose text, prompt and model are unchanged since the last run (outputs present) are skipped
+        self.SKIP_UNCHANGED = skip_unchanged
+        self.MANIFEST_PATH = self.EDU_OUTPUT / ".manifest.json"
 
         # Logging
         self._setup_logging()
 
-        # OpenAI
+        # Responses are cached next to the outputs, so re-runs on unchanged text skip the API
+        self.cache = LLMResponseCache(self.EDU_OUTPUT / ".llm_cache", enabled=enable_cache and cacheable_temperature(temperature))
+
+        # OpenAI (the async client is created per run, inside the event loop that uses it)
         load_dotenv()
-        self.client = OpenAI()
+        self.aclient = None
+        self._llm_sem = None
+        self._rpm = self._tpm = None
 
-        # Load prompt once
+        # Load prompt once and split it around the document marker
         self.base_prompt = self._load_prompt()
+        self.prompt_prefix, self.prompt_suffix = split_prompt(self.base_prompt)
+        # Paper text gets whatever the context leaves after the reply and the fixed prompt parts
+        overhead = count_tokens(EDU_SYSTEM_PROMPT + self.prompt_prefix + self.prompt_suffix, self.MODEL)
+        self.text_budget = max(0, min(self.TEXT_LIMIT, self.CONTEXT_WINDOW - self.MAX_TOKENS - overhead))
 
-        print(f"EduMaterialsGenerator initialized.")
-        print(f"Input: {self.TXT_DIR}")
-        print(f"Output: {self.EDU_OUTPUT}")
+        logger.info(f"EduMaterialsGenerator initialized.")
+        logger.info(f"Input: {self.TXT_DIR}")
+        logger.info(f"Output: {self.EDU_OUTPUT}")
 
     def _setup_logging(self):
         timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
         log_dir = self.SCRIPT_DIR / "logs"
         log_dir.mkdir(exist_ok=True)
         log_file = log_dir / f"edu_materials_log_{timestamp}.txt"
-        log_f = open(log_file, "w", encoding="utf-8")
-        sys.stdout = Tee(sys.__stdout__, log_f)
-        sys.stderr = Tee(sys.__stderr__, log_f)
+        attach_log_file(logger, log_file)
         self.log_file = log_file
-        print(f"Logging to {self.log_file}")
+        logger.info(f"Logging to {self.log_file}")
 
     def _load_prompt(self) -> str:
         if not self.PROMPT_PATH.exists():
             raise FileNotFoundError(f"Prompt file not found: {self.PROMPT_PATH}")
-        return self.PROMPT_PATH.read_text(encoding="utf-8")
+        return read_prompt(self.PROMPT_PATH)
+
+    def _cache_key(self, prompt_text: str) -> str:
+        # Everything that changes the response: editing the system prompt or limits invalidates entries
+        return LLMResponseCache.key(self.MODEL, self.MAX_TOKENS, self.TEMPERATURE, EDU_SYSTEM_PROMPT, prompt_text)
 
-    def _truncate_text(self, text: str) -> str:
-        return text if len(text) <= self.TEXT_LIMIT else text[: self.TEXT_LIMIT] + "\n\n[Text truncated for LLM]"
+    def _request_body(self, prompt_text: str) -> Dict[str, Any]:
+        """Chat-completions parameters, shared by direct calls and Batch API lines."""
+        return {
+            "model": self.MODEL,
+            "messages": [
+                {"role": "system", "content": EDU_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt_text},
+            ],
+            "max_tokens": self.MAX_TOKENS,
+            "temperature": self.TEMPERATURE,
+            "response_format": {"type": "json_object"},
+        }
 
-    def _call_llm(self, prompt_text: str) -> str:
+    async def _call_llm(self, prompt_text: str, stream: _StreamedOutputs = None) -> str:
+        key = self._cache_key(prompt_text)
+        cached = self.cache.get(key)
+        if cached is not None:
+            logger.info("Using cached LLM response.")
+            return cached
+
+        # Rough estimate: ~4 characters per prompt token, plus the full completion budget
+        estimate = len(prompt_text) // 4 + self.MAX_TOKENS
         for attempt in range(self.MAX_RETRIES):
             try:
-                resp = self.client.chat.completions.create(
-                    model=self.MODEL,
-                    messages=[
-                        {
-                            "role": "system",
-                            "content": (
-                                "You are an educational AI tutor that outputs structured JSON only. "
-                                "If the paper has few metrics, you may generate example metrics for teaching, "
-                                "but keep consistent JSON keys. "
-                                "Never output markdown or commentary — JSON only."
-                            ),
-                        },
-                        {"role": "user", "content": prompt_text},
-                    ],
-                    max_tokens=self.MAX_TOKENS,
-                    temperature=self.TEMPERATURE,
-                    response_format={"type": "json_object"},
-                )
-                return resp.choices[0].message.content.strip()
+                if self._rpm:
+                    await self._rpm.acquire()
+                if self._tpm:
+                    await self._tpm.acquire(estimate)
+                # The configured limits are estimates; the API's own headers can still say to hold off
+                await rate_limit_gate().wait_async()
+                # Only the request itself holds a slot: cache hits and backoff sleeps don't
+                async with self._llm_sem:
+                    if stream is None:
+                        resp = await self.aclient.chat.completions.create(**self._request_body(prompt_text))
+                        usage = getattr(resp, "usage", None)
+                        content = resp.choices[0].message.content
+                    else:
+                        stream.reset()
+                        deltas, usage = [], None
+                        chunks = await self.aclient.chat.completions.create(
+                            **self._request_body(prompt_text), stream=True, stream_options={"include_usage": True}
+                        )
+                        async for chunk in chunks:
+                            delta = chunk.choices[0].delta.content if chunk.choices else None
+                            if delta:
+                                deltas.append(delta)
+                                stream.feed(delta)
+                            usage = getattr(chunk, "usage", None) or usage # Sent with the last chunk
+                        content = "".join(deltas)
+                if self._tpm and usage is not None and usage.total_tokens:
+                    # Replies rarely use all of max_tokens; the unused part goes back to the other papers
+                    self._tpm.release(estimate - usage.total_tokens)
+                content = content.strip()
+                self.cache.put(key, content)
+                return content
             except Exception as e:
-                print(f"Attempt {attempt + 1} failed: {e}")
+                logger.warning(f"Attempt {attempt + 1} failed: {e}")
                 if attempt == self.MAX_RETRIES - 1:
                     raise
-                time.sleep(2 ** attempt)
+                await asyncio.sleep(retry_delay(e, attempt))
         return ""
 
     def _clean_raw(self, raw: str) -> str:
-        if not raw:
-            return ""
-        if raw.startswith("```"):
-            parts = raw.split("```", 2)
-            raw = parts[1] if len(parts) > 2 else parts[0]
-        raw = raw.strip()
-        if raw.lower().startswith("json"):
-            raw = raw[4:].strip()
-        return raw
+        # json_object responses are almost always bare JSON; the regex fails on the first character then
+        return strip_json_fence(raw)
+
+    @staticmethod
+    def _new_deck():
+        prs = Presentation(io.BytesIO(_blank_pptx_bytes()))
+        # "Title and Content" layout, resolved once for the whole deck
+        layout = prs.slide_layouts[1] if len(prs.slide_layouts) > 1 else prs.slide_layouts[0]
+        return prs, layout
+
+    @staticmethod
+    def _add_slide(prs, layout, slide: Dict):
+        s = prs.slides.add_slide(layout)
+
+        # Title
+        title = slide.get("Title") or slide.get("Heading") or "Untitled"
+        title_shape = s.shapes.title
+        if title_shape is not None:
+            title_shape.text = str(title)
+
+        # Content
+        if slide.get("Content"):
+            content_text = slide.get("Content")
+        else:
+            parts = []
+            for k in ("Equation", "ConceptExplanation", "DeepExplanation", "RealExample", "ImageIdea"):
+                v = slide.get(k)
+                if v:
+                    parts.append(f"{k}: {v}")
+            content_text = "\n\n".join(parts) if parts else ""
+
+        # Body placeholder (idx 1 on the content layout)
+        try:
+            body_shape = s.placeholders[1]
+        except KeyError:
+            body_shape = s.shapes.add_textbox(Inches(0.5), Inches(0.5), Inches(9), Inches(4.5))
+
+        body_shape.text_frame.clear()
+        content_text = content_text[:4000] or "No detailed content available."
+        p = body_shape.text_frame.paragraphs[0]
+        p.text = content_text
 
     def _create_ppt(self, slides: List[Dict], output_path: Path, raw_json_sample: Dict = None):
-        prs = Presentation()
+        prs, layout = self._new_deck()
         for slide in slides:
-            layout = prs.slide_layouts[1] if len(prs.slide_layouts) > 1 else prs.slide_layouts[0]
-            s = prs.slides.add_slide(layout)
-
-            # Title
-            title = slide.get("Title") or slide.get("Heading") or "Untitled"
-            try:
-                s.shapes.title.text = str(title)
-            except Exception:
-                pass
-
-            # Content
-            if slide.get("Content"):
-                content_text = slide.get("Content")
-            else:
-                parts = []
-                for k in ("Equation", "ConceptExplanation", "DeepExplanation", "RealExample", "ImageIdea"):
-                    v = slide.get(k)
-                    if v:
-                        parts.append(f"{k}: {v}")
-                content_text = "\n\n".join(parts) if parts else ""
-
-            # Find body placeholder
-            body_shape = None
-            for shape in s.shapes:
-                if hasattr(shape, "text_frame") and shape != s.shapes.title:
-                    body_shape = shape
-                    break
-
-            if body_shape is None:
-                left = top = Inches(0.5)
-                width = Inches(9)
-                height = Inches(4.5)
-                body_shape = s.shapes.add_textbox(left, top, width, height)
-
-            body_shape.text_frame.clear()
-            content_text = content_text[:4000] or "No detailed content available."
-            p = body_shape.text_frame.paragraphs[0]
-            p.text = content_text
+            self._add_slide(prs, layout, slide)
+        self._save_ppt(prs, output_path, raw_json_sample)
 
+    def _save_ppt(self, prs, output_path: Path, raw_json_sample: Dict = None):
         prs.save(output_path)
-        print(f"Slides saved to {output_path}")
+        logger.info(f"Slides saved to {output_path}")
 
         if raw_json_sample:
             raw_path = output_path.with_suffix(".raw.json")
-            raw_path.write_text(json.dumps(raw_json_sample, ensure_ascii=False, indent=2), encoding="utf-8")
-            print(f"Raw JSON saved to {raw_path}")
+            raw_path.write_bytes(json_dumps_pretty(raw_json_sample))
+            logger.info(f"Raw JSON saved to {raw_path}")
 
     def _create_lab_zip(self, labs: List[Dict], output_zip_path: Path):
         if not labs:
-            print("No labs to package.")
+            logger.info("No labs to package.")
             return
 
-        with ZipFile(output_zip_path, "w") as zf:
+        with ZipFile(output_zip_path, "w", ZIP_DEFLATED) as zf:
             for i, lab in enumerate(labs, start=1):
-                title = lab.get("Title", f"Lab_{i}")
-                dataset = lab.get("Dataset", {})
-                codefiles = lab.get("CodeFiles", [])
-
-                # CSV
-                if dataset:
-                    csv_name = dataset.get("filename", f"{title.replace(' ', '_')}.csv")
-                    csv_content = "x,y,true_label,pred_label\n1,0.8,1,1\n2,0.3,1,0\n3,0.9,0,1\n"
-                    zf.writestr(csv_name, csv_content)
-                    readme = f"# Dataset: {csv_name}\n\n{dataset.get('description', '')}\n"
-                    zf.writestr(f"{title}_README.txt", readme)
-
-                # Python files
-                for j, cfile in enumerate(codefiles, start=1):
-                    name = cfile.get("filename", f"exercise_{i}_{j}.py")
-                    desc = cfile.get("description", "")
-                    code_content = (
-                        f"# {desc}\n"
-                        f"import pandas as pd\nimport numpy as np\nimport matplotlib.pyplot as plt\n\n"
-                        f"data = pd.read_csv('{dataset.get('filename','data.csv')}')\n"
-                        f"print(data.head())\n"
-                    )
-                    zf.writestr(name, code_content)
-
-        print(f"Lab files saved to {output_zip_path}")
-
-    def process_single(self, txt_path: Path) -> Tuple[List[Dict], List[Dict], Dict]:
+                self._write_lab(zf, i, lab)
+
+        logger.info(f"Lab files saved to {output_zip_path}")
+
+    @staticmethod
+    def _write_lab(zf: ZipFile, i: int, lab: Dict):
+        title = lab.get("Title", f"Lab_{i}")
+        dataset = lab.get("Dataset", {})
+        codefiles = lab.get("CodeFiles", [])
+
+        # CSV
+        if dataset:
+            csv_name = dataset.get("filename", f"{title.replace(' ', '_')}.csv")
+            _write_entry(zf, csv_name, CSV_CONTENT_BYTES)
+            readme = f"# Dataset: {csv_name}\n\n{dataset.get('description', '')}\n"
+            _write_entry(zf, f"{title}_README.txt", readme.encode("utf-8"))
+
+        # Python files (only the description line differs between exercises of a lab)
+        code_body = CODE_IMPORTS_BYTES + f"data = pd.read_csv('{dataset.get('filename','data.csv')}')\nprint(data.head())\n".encode("utf-8")
+        for j, cfile in enumerate(codefiles, start=1):
+            name = cfile.get("filename", f"exercise_{i}_{j}.py")
+            desc = cfile.get("description") or "" # The LLM may send null or a non-string
+            code_content = f"# {desc}\n".encode("utf-8") + code_body
+            _write_entry(zf, name, code_content)
+
+    def _build_prompt(self, txt_path: Path) -> str:
+        text = read_truncated_tokens(txt_path, self.text_budget, self.MODEL) # Only the part sent to the LLM is read
+        return self.prompt_prefix + text + self.prompt_suffix
+
+    async def process_single(self, txt_path: Path, stream: _StreamedOutputs = None) -> Tuple[List[Dict], List[Dict], Dict]:
         """Process one .txt file and return slides, labs, raw data."""
-        print(f"\nProcessing {txt_path.name}")
-        text = self._truncate_text(txt_path.read_text(encoding="utf-8"))
-        prompt = self.base_prompt.replace("<<<DOCUMENT_TEXT>>>", text)
+        logger.info(f"\nProcessing {txt_path.name}")
+        raw = await self._call_llm(self._build_prompt(txt_path), stream=stream)
+        return self._parse_response(txt_path, raw)
 
-        raw = self._call_llm(prompt)
+    def _parse_response(self, txt_path: Path, raw: str) -> Tuple[List[Dict], List[Dict], Dict]:
         cleaned = self._clean_raw(raw)
 
         if not cleaned:
-            print("No response from GPT.")
+            logger.info("No response from GPT.")
             return [], [], {}
 
         debug_path = self.EDU_OUTPUT / f"{txt_path.stem}_raw.txt"
         debug_path.write_text(cleaned, encoding="utf-8")
 
         try:
-            data = json.loads(cleaned)
+            data = json_loads(cleaned)
             slides = data.get("Slides", [])
             labs = data.get("Labs", [])
-            print(f"Parsed: {len(slides)} slides, {len(labs)} labs")
+            logger.info(f"Parsed {txt_path.name}: {len(slides)} slides, {len(labs)} labs")
             return slides, labs, data
         except json.JSONDecodeError as e:
-            print(f"JSON parse error: {e}")
-            print("Raw:", cleaned[:1000])
+            logger.error(f"JSON parse error in {txt_path.name}: {e}")
+            logger.info(f"Raw: {cleaned[:1000]}")
             return [], [], {}
 
+    async def _generate_single(self, txt_path: Path) -> Optional[Dict[str, Any]]:
+        """Run the LLM call for one file, then write its PPTX and ZIP off the event loop, side by side."""
+        streamed = _StreamedOutputs(self) if self.STREAM_OUTPUTS else None
+        slides, labs, data = await self.process_single(txt_path, stream=streamed)
+        if not slides and not labs:
+            logger.info(f"No content generated for {txt_path.name}")
+            return None
+
+        out_ppt, out_zip = self._output_paths(txt_path)
+        if streamed is not None and streamed.matches(slides, labs):
+            # Slides and labs were built while the reply streamed in; only saving is left
+            await asyncio.to_thread(streamed.save, out_ppt if slides else None, out_zip if labs else None, data)
+            return self._result_entry(txt_path, slides, labs)
+        writes = []
+        if slides:
+            writes.append(asyncio.to_thread(self._create_ppt, slides, out_ppt, data))
+        if labs:
+            writes.append(asyncio.to_thread(self._create_lab_zip, labs, out_zip))
+        await asyncio.gather(*writes)
+        return self._result_entry(txt_path, slides, labs)
+
+    def _output_paths(self, txt_path: Path) -> Tuple[Path, Path]:
+        return (self.EDU_OUTPUT / f"slides_{txt_path.stem}.pptx",
+                self.EDU_OUTPUT / f"lab_{txt_path.stem}.zip")
+
+    def _result_entry(self, txt_path: Path, slides: List[Dict], labs: List[Dict]) -> Dict[str, Any]:
+        out_ppt, out_zip = self._output_paths(txt_path)
+        return {
+            "file": txt_path.name,
+            "pptx": out_ppt.name if slides else None,
+            "zip": out_zip.name if labs else None,
+            "slides_count": len(slides),
+            "labs_count": len(labs),
+        }
+
+    def _write_outputs(self, txt_path: Path, slides: List[Dict], labs: List[Dict], data: Dict) -> Optional[Dict[str, Any]]:
+        if not slides and not labs:
+            logger.info(f"No content generated for {txt_path.name}")
+            return None
+
+        out_ppt, out_zip = self._output_paths(txt_path)
+        if slides:
+            self._create_ppt(slides, out_ppt, raw_json_sample=data)
+        if labs:
+            self._create_lab_zip(labs, out_zip)
+        return self._result_entry(txt_path, slides, labs)
+
+    async def _generate_all_async(self, txt_files: List[Path]) -> List[Dict[str, Any]]:
+        # Keep up to MAX_CONCURRENCY requests in flight; gather() preserves file order
+        self._llm_sem = asyncio.Semaphore(self.MAX_CONCURRENCY)
+        self._rpm = AsyncTokenBucket(self.REQUESTS_PER_MINUTE) if self.REQUESTS_PER_MINUTE else None
+        self._tpm = AsyncTokenBucket(self.TOKENS_PER_MINUTE) if self.TOKENS_PER_MINUTE else None
+        # Retries are handled in _call_llm, so the SDK's own retries are disabled
+        self.aclient = AsyncOpenAI(http_client=openai_http_client(async_client=True), max_retries=0)
+        try:
+            results = await asyncio.gather(*(self._generate_single(p) for p in txt_files))
+        finally:
+            await self.aclient.close()
+            self.aclient = None
+        return [r for r in results if r]
+
+    def _generate_all_batch(self, txt_files: List[Path]) -> List[Dict[str, Any]]:
+        """Submit all uncached prompts as one Batch API job, wait for it, then build outputs."""
+        client = OpenAI(http_client=shared_openai_http_client()) # Process-wide pool; never closed here
+        prompts = {p.stem: self._build_prompt(p) for p in txt_files}
+        responses = {}
+        pending = {}
+        for stem, prompt in prompts.items():
+            cached = self.cache.get(self._cache_key(prompt))
+            if cached is not None:
+                responses[stem] = cached
+            else:
+                pending[stem] = prompt
+
+        if pending:
+            batch_dir = self.EDU_OUTPUT / ".batch"
+            batch_dir.mkdir(exist_ok=True)
+            batch_input = batch_dir / "batch_input.jsonl"
+            with open(batch_input, "wb") as f:
+                for stem, prompt in pending.items():
+                    line = {"custom_id": stem, "method": "POST", "url": "/v1/chat/completions",
+                            "body": self._request_body(prompt)}
+                    f.write(json_dumps(line) + b"\n")
+
+            with open(batch_input, "rb") as f:
+                upload = client.files.create(file=f, purpose="batch")
+            batch = client.batches.create(input_file_id=upload.id, endpoint="/v1/chat/completions",
+                                          completion_window="24h")
+            logger.info(f"Submitted batch {batch.id} with {len(pending)} requests ({len(responses)} cached).")
+
+            while batch.status not in ("completed", "failed", "expired", "cancelled"):
+                time.sleep(self.BATCH_POLL_SECONDS)
+                batch = client.batches.retrieve(batch.id)
+                logger.info(f"Batch {batch.id}: {batch.status}")
+            if batch.status != "completed":
+                raise RuntimeError(f"Batch {batch.id} ended with status '{batch.status}'")
+
+            if batch.output_file_id:
+                for line in client.files.content(batch.output_file_id).text.splitlines():
+                    if not line.strip():
+                        continue
+                    item = json_loads(line)
+                    response = item.get("response") or {}
+                    if response.get("status_code") != 200:
+                        logger.error(f"Batch request {item.get('custom_id')} failed: {item.get('error') or response}")
+                        continue
+                    stem = item["custom_id"]
+                    content = response["body"]["choices"][0]["message"]["content"].strip()
+                    self.cache.put(self._cache_key(pending[stem]), content)
+                    responses[stem] = content
+
+        # Replies are parsed in order while a small pool saves the previous papers' PPTX/ZIP files
+        with ThreadPoolExecutor(max_workers=2) as writer:
+            writes = []
+            for txt_path in txt_files:
+                logger.info(f"\nProcessing {txt_path.name}")
+                slides, labs, data = self._parse_response(txt_path, responses.get(txt_path.stem, ""))
+                writes.append(writer.submit(self._write_outputs, txt_path, slides, labs, data))
+            results = [fut.result() for fut in writes]
+        return [r for r in results if r]
+
+    # ------------------------------------------------------------------
+    # Up-to-date check (manifest of input fingerprints -> previous results)
+    # ------------------------------------------------------------------
+    def _fingerprint(self, txt_path: Path) -> str:
+        h = hashlib.sha256(txt_path.read_bytes())
+        h.update(self._cache_key(self.base_prompt).encode()) # Prompt/model/settings changes invalidate too
+        return h.hexdigest()
+
+    def _load_manifest(self) -> Dict[str, Any]:
+        try:
+            return json_loads(self.MANIFEST_PATH.read_bytes())
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save_manifest(self, manifest: Dict[str, Any]) -> None:
+        tmp = self.MANIFEST_PATH.with_suffix(".json.tmp")
+        tmp.write_bytes(json_dumps_pretty(manifest))
+        os.replace(tmp, self.MANIFEST_PATH)
+
+    def _up_to_date(self, txt_path: Path, entry: Optional[Dict[str, Any]], fingerprint: str) -> bool:
+        if not entry or entry.get("fingerprint") != fingerprint:
+            return False
+        outputs = [entry["result"].get(k) for k in ("pptx", "zip")]
+        paths = [self.EDU_OUTPUT / name for name in outputs if name]
+        txt_mtime = txt_path.stat().st_mtime
+        return bool(paths) and all(p.exists() and p.stat().st_mtime >= txt_mtime for p in paths)
+
     def generate_all(self) -> List[Dict[str, Any]]:
-        """Process all .txt files in TXT_DIR and generate PPTX + ZIP."""
-        txt_files = sorted(self.TXT_DIR.glob("*.txt"))
+        """Process all .txt files in TXT_DIR concurrently and generate PPTX + ZIP."""
+        txt_files = list_files(self.TXT_DIR, ".txt")
         if not txt_files:
-            print("No .txt files found")
+            logger.info("No .txt files found")
             return []
 
-        results = []
+        manifest = self._load_manifest() if self.SKIP_UNCHANGED else {}
+        fingerprints = {p.name: self._fingerprint(p) for p in txt_files} if self.SKIP_UNCHANGED else {}
+        todo, skipped = [], {}
         for txt_path in txt_files:
-            slides, labs, data = self.process_single(txt_path)
-
-            if not slides and not labs:
-                print(f"No content generated for {txt_path.name}")
-                continue
-
-            out_ppt = self.EDU_OUTPUT / f"slides_{txt_path.stem}.pptx"
-            out_zip = self.EDU_OUTPUT / f"lab_{txt_path.stem}.zip"
-
-            if slides:
-                self._create_ppt(slides, out_ppt, raw_json_sample=data)
-            if labs:
-                self._create_lab_zip(labs, out_zip)
-
-            results.append({
-                "file": txt_path.name,
-                "pptx": out_ppt.name if slides else None,
-                "zip": out_zip.name if labs else None,
-                "slides_count": len(slides),
-                "labs_count": len(labs),
-            })
-
-        print("\nAll papers processed successfully!")
-        print(f"Log file: {self.log_file}")
+            entry = manifest.get(txt_path.name)
+            if self.SKIP_UNCHANGED and self._up_to_date(txt_path, entry, fingerprints[txt_path.name]):
+                logger.info(f"⏭ {txt_path.name} is up to date, skipping.")
+                skipped[txt_path.name] = entry["result"]
+            else:
+                todo.append(txt_path)
+
+        new_results = []
+        if todo:
+            if self.USE_BATCH:
+                new_results = self._generate_all_batch(todo)
+            else:
+                new_results = asyncio.run(self._generate_all_async(todo))
+
+        # Keep results in file order, mixing reused and freshly generated entries
+        by_name = dict(skipped)
+        by_name.update({r["file"]: r for r in new_results})
+        results = [by_name[p.name] for p in txt_files if p.name in by_name]
+
+        if self.SKIP_UNCHANGED:
+            for r in new_results:
+                manifest[r["file"]] = {"fingerprint": fingerprints[r["file"]], "result": r}
+            try:
+                self._save_manifest(manifest)
+            except Exception as e:
+                logger.warning(f"⚠️ Could not update manifest: {e}")
+
+        logger.info("\nAll papers processed successfully!")
+        logger.info(f"Log file: {self.log_file}")
         return results
     
 
@@ -295,14 +591,16 @@ def run(pdf_path, out_dir, prev=None):
             script_dir=SCRIPT_DIR,
             txt_dir=f"data/extracted_text/{p.stem}",
             prompt_path="prompts/[Prompt]explain_and_lab.txt",
-            output_dir=str(out)
+            output_dir=str(out),
+            use_batch=batch_api_enabled() or os.getenv("EDU_USE_BATCH_API") == "1",
+            stream_outputs=os.getenv("EDU_STREAM_OUTPUTS") == "1",
         )
         
         # Generate materials
         results = generator.generate_all()
         
         # Return files created
-        files = [f.name for f in out.glob("*") if f.is_file()]
+        files = [f.name for f in list_files(out, "")]
         return {
             "status": "success",
             "files": files,
@@ -310,6 +608,6 @@ def run(pdf_path, out_dir, prev=None):
         }
         
     except Exception as e:
-        print(f"ERROR in generate_edu: {e}")
+        logger.error(f"ERROR in generate_edu: {e}")
         return {"status": "error", "error": str(e)}
 
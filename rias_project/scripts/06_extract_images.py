@@ -1,8 +1,13 @@
 import os
+import re
+import fnmatch
+import multiprocessing
 from pathlib import Path
 from typing import Union, Iterable, Optional
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from extract_image.extract_images import extract_images_from_pdf
 from extract_image.render_pages import render_pdf_pages
+from utils import list_files
 
 
 class PDFImageExtractor:
@@ -14,9 +19,12 @@ class PDFImageExtractor:
         extractor.run(pattern="*report*.pdf", zoom=4)
     """
 
-    def __init__(self, input_dir: Union[str, Path], output_dir: Union[str, Path]):
+    def __init__(self, input_dir: Union[str, Path], output_dir: Union[str, Path], page_workers: int = 1):
         self.input_dir = Path(input_dir)
         self.output_dir = Path(output_dir)
+        # Opt-in processes to split one long PDF by page range; the default keeps extraction in this
+        # process (main.py calls it from a stage thread, and process_pdfs already runs one PDF per process)
+        self.page_workers = max(1, page_workers)
 
         if not self.input_dir.exists():
             raise FileNotFoundError(f"Input directory not found: {self.input_dir}")
@@ -40,10 +48,12 @@ class PDFImageExtractor:
         print(f"Processing {pdf_path.name} → {pdf_out_dir.name}/")
 
         # Extract embedded images
-        extract_images_from_pdf(str(pdf_path), str(pdf_out_dir))
+        duplicates = extract_images_from_pdf(str(pdf_path), str(pdf_out_dir), page_workers=self.page_workers)
+        if duplicates:
+            print(f"♻️ Skipped {len(duplicates)} repeated image(s) in {pdf_path.name}")
 
         # Optionally render full pages (disabled if not needed)
-        # render_pdf_pages(str(pdf_path), str(pdf_out_dir), zoom=zoom)
+        # render_pdf_pages(str(pdf_path), str(pdf_out_dir), zoom=zoom, page_workers=self.page_workers)
 
     # ------------------------------------------------------------------
     # Process multiple PDFs
@@ -53,36 +63,38 @@ class PDFImageExtractor:
         *,
         pdf_names: Optional[Union[str, Iterable[str]]] = None,
         pattern: Optional[str] = None,
-        zoom: int = 4
+        zoom: int = 4,
+        max_workers: Optional[int] = None
     ) -> None:
         """
-        Process selected PDFs and extract images + render pages.
+        Process selected PDFs in parallel and extract images + render pages.
 
         Args:
             pdf_names: Specific PDF filenames (string or list).
             pattern: Optional glob pattern (e.g. "*2025*.pdf").
             zoom: Page rendering zoom factor (default=4).
+            max_workers: Worker processes (default: number of CPUs).
         """
-        all_pdfs = {p.name: p for p in self.input_dir.glob("*.pdf")}
-        if not all_pdfs:
+        pdf_paths = list_files(self.input_dir, ".pdf")
+        if not pdf_paths:
             print(f"No PDF files found in {self.input_dir}")
             return
 
-        # 1️⃣ Filter by names
+        # 1️⃣ Filter by names (the name → path map is only needed here)
         if pdf_names is not None:
+            all_pdfs = {p.name: p for p in pdf_paths}
             if isinstance(pdf_names, str):
                 pdf_names = [pdf_names]
             selected = {name for name in pdf_names if name in all_pdfs}
             missing = set(pdf_names) - selected
             if missing:
                 print(f"⚠️ Warning: Not found: {', '.join(missing)}")
-            pdf_paths = [all_pdfs[name] for name in selected]
-        else:
-            pdf_paths = list(all_pdfs.values())
+            pdf_paths = [all_pdfs[name] for name in sorted(selected)]
 
-        # 2️⃣ Filter by glob pattern
+        # 2️⃣ Filter by glob pattern, compiled once and matched against the file name
         if pattern:
-            pdf_paths = [p for p in pdf_paths if p.match(pattern)]
+            rx = re.compile(fnmatch.translate(pattern))
+            pdf_paths = [p for p in pdf_paths if rx.match(p.name)]
 
         if not pdf_paths:
             print("No PDFs matched the selection criteria.")
@@ -90,10 +102,26 @@ class PDFImageExtractor:
 
         print(f"📘 Found {len(pdf_paths)} PDF(s) to process...\n")
 
-        for pdf_path in sorted(pdf_paths):
-            self.process_single_pdf(pdf_path, zoom=zoom)
-
-        print(f"\n✅ All {len(pdf_paths)} PDF(s) processed successfully!")
+        # PDFs are independent and MuPDF work is CPU-bound, so spread them over processes; each one
+        # runs process_single_pdf (same output folder, page workers and duplicate handling as run()).
+        # Spawned, not forked, so a worker never inherits a lock held by another thread of the caller
+        workers = min(len(pdf_paths), max_workers or os.cpu_count() or 1)
+        failed = 0
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as ex:
+            futures = {ex.submit(self.process_single_pdf, p, zoom): p for p in pdf_paths}
+            for fut in as_completed(futures):
+                pdf_path = futures[fut]
+                try:
+                    fut.result()
+                    print(f"Processed {pdf_path.name} → {self.output_dir.name}/")
+                except Exception as e:
+                    failed += 1
+                    print(f"❌ Failed {pdf_path.name}: {e}")
+
+        if failed:
+            print(f"\n⚠️ {failed} of {len(pdf_paths)} PDF(s) failed.")
+        else:
+            print(f"\n✅ All {len(pdf_paths)} PDF(s) processed successfully!")
         print(f"   Output saved in: {self.output_dir}")
 
     # ------------------------------------------------------------------
@@ -119,7 +147,7 @@ def run(pdf_path, out_dir, prev=None):
         
         # Return success with list of generated files
         # This will now correctly find the images inside 'out_dir'
-        files = [f.name for f in out.glob("*") if f.is_file()]
+        files = [f.name for f in list_files(out, "")]
         return {
             "status": "success", 
             "files": files,
@@ -142,15 +170,16 @@ if __name__ == "__main__":
     parser.add_argument("input_dir", type=str, help="Path to folder containing PDFs")
     parser.add_argument("output_dir", type=str, help="Path to output folder")
     parser.add_argument("--pdfs", type=str, nargs="+", help="Specific PDF filenames")
-    parser.add.argument("--pattern", type=str, help="Glob pattern (e.g. '*invoice*.pdf')")
-    parser.add.argument("--zoom", type=int, default=4, help="Zoom factor for rendering")
-    args = parser.parse.args()
+    parser.add_argument("--pattern", type=str, help="Glob pattern (e.g. '*invoice*.pdf')")
+    parser.add_argument("--zoom", type=int, default=4, help="Zoom factor for rendering")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: number of CPUs)")
+    args = parser.parse_args()
 
     extractor = PDFImageExtractor(args.input_dir, args.output_dir)
     pdf_names = None if not args.pdfs or args.pdfs == ["all"] else args.pdfs
     
     # This is the old .run() method, it's fine for CLI use
-    extractor.process_pdfs(pdf_names=pdf_names, pattern=args.pattern, zoom=args.zoom)
+    extractor.process_pdfs(pdf_names=pdf_names, pattern=args.pattern, zoom=args.zoom, max_workers=args.workers)
 # ---------------------------------------------------------------------- #
 # import os
 # from pathlib import Path
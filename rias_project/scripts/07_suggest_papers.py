@@ -1,30 +1,36 @@
+import asyncio
 import json
-import sys
-import time
+import os
 import datetime
+from operator import itemgetter
 from pathlib import Path
 from dotenv import load_dotenv
-from openai import OpenAI
-import pandas as pd
-from openpyxl import Workbook
-
-
-# ----------------------------------------------------------------------
-# LOGGING HELPER
-# ----------------------------------------------------------------------
-class Tee:
-    """Duplicates stdout/stderr output to both console and log file."""
-    def __init__(self, *files):
-        self.files = files
-
-    def write(self, obj):
-        for f in self.files:
-            f.write(obj)
-            f.flush()
-
-    def flush(self):
-        for f in self.files:
-            f.flush()
+from utils import (
+    EMBED_MODEL, TRUNCATION_NOTE, EmbeddingCache, LLMResponseCache, SemanticResponseCache, cacheable_temperature,
+    relevant_chunks_enabled, select_relevant, semantic_cache_enabled, split_chunks,
+    add_layout_sheet, new_write_only_workbook,
+    attach_log_file, get_logger, json_dumps, json_loads, openai_http_client,
+    CHARS_PER_TOKEN, count_tokens, raw_chat_completion, raw_http_enabled, read_prompt, read_truncated_tokens,
+    rate_limit_gate, retry_delay, split_prompt, strip_json_fence,
+)
+
+load_dotenv() # Once at import; the API key is read from the environment by the client
+
+logger = get_logger("rias.suggest")
+
+SUGGEST_SYSTEM_PROMPT = "You are an academic research assistant. Return only valid JSON."
+# Appended after the documents when several papers share one request
+BATCH_INSTRUCTIONS = (
+    "\n\nThe text above contains several papers, each starting with a line '=== FILE n: <name> ==='. "
+    "Suggest related works for each paper separately and return valid JSON of the form "
+    '{"Results": [{"Source File": "<name>", "Suggestions": [...]}]} with one entry per file, '
+    "using the Suggestions structure described above."
+)
+SUGGESTION_COLUMNS = ["Source File", "File Name", "Author", "Summary Information", "Keywords", "Reference Link"]
+_SUGGESTION_KEYS = frozenset(SUGGESTION_COLUMNS)
+_BLANK_ROW = dict.fromkeys(SUGGESTION_COLUMNS, "")
+_get_row = itemgetter(*SUGGESTION_COLUMNS)
+SUGGESTION_SHEET = {"title": "Suggested Papers", "widths": {}, "freeze_panes": "A2", "rows": [SUGGESTION_COLUMNS]}
 
 
 # ----------------------------------------------------------------------
@@ -33,9 +39,9 @@ class Tee:
 class PaperSuggester:
     """Suggests related research papers for extracted text files using GPT."""
 
-    def __init__(self, txt_dir: Path, prompt_path: Path, output_xlsx: Path):
-        load_dotenv()
-
+    def __init__(self, txt_dir: Path, prompt_path: Path, output_xlsx: Path, max_concurrency: int = None,
+                 enable_cache: bool = True, batch_size: int = 4, log_dir: Path = None,
+                 text_tokens: int = 5_000, context_window: int = 128_000):
         # --- Paths and logging setup ---
         self.timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
         self.script_dir = Path(__file__).resolve().parent.parent # For standalone mode
@@ -43,21 +49,13 @@ class PaperSuggester:
         # Setup log dir relative to output
         self.output_xlsx = output_xlsx
         self.output_xlsx.parent.mkdir(parents=True, exist_ok=True)
-        try:
-            # Try to put logs in central 'logs' folder
-            self.log_dir = self.output_xlsx.parent.parent.parent.parent / "logs"
-            if not self.log_dir.exists():
-                self.log_dir = self.output_xlsx.parent / "logs"
-        except Exception:
-            self.log_dir = self.output_xlsx.parent / "logs"
-        
+        # The pipeline passes its session log folder; otherwise RIAS_LOG_DIR, else next to the output
+        self.log_dir = Path(log_dir or os.getenv("RIAS_LOG_DIR") or self.output_xlsx.parent / "logs")
         self.log_dir.mkdir(parents=True, exist_ok=True)
         self.log_file = self.log_dir / f"suggest_papers_log_{self.timestamp}.txt"
 
-        # Redirect stdout/stderr to both console and log file
-        self.log_f = open(self.log_file, "w", encoding="utf-8")
-        sys.stdout = Tee(sys.__stdout__, self.log_f)
-        sys.stderr = Tee(sys.__stderr__, self.log_f)
+        # Console + log file through the module logger (no stdout redirection)
+        attach_log_file(logger, self.log_file)
 
         # --- Configuration from args ---
         self.txt_dir = txt_dir
@@ -69,123 +67,299 @@ class PaperSuggester:
         self.max_tokens = 10000
         self.temperature = 0.4
         self.max_retries = 3
-        self.client = OpenAI()
+        # Paper text is cut by tokens (tiktoken when installed), so dense or CJK text cannot overflow the model
+        self.text_tokens = text_tokens
+        self.text_limit = text_tokens * CHARS_PER_TOKEN # Character estimate, for batching and chunk selection
+        self.context_window = context_window
+        # Papers per request in run(); a shared request pays the instructions and round-trip once
+        self.batch_size = max(1, batch_size)
+        self.batch_char_limit = 400_000 # ~100k input tokens per request
+        # Requests in flight per run; OPENAI_CONCURRENCY lets deployments match their rate-limit tier
+        self.max_concurrency = max_concurrency or int(os.getenv("OPENAI_CONCURRENCY", "8"))
+        # The async client and request semaphore are created per run, inside the event loop that uses them
+        self.client = None
+        self._http = None # Set per run when RIAS_RAW_HTTP=1
+        self._llm_sem = None
+        # Shared across sessions (outputs are per session), so re-runs on unchanged text skip the API;
+        # only for near-deterministic sampling, so at the default 0.4 replies are not replayed
+        enable_cache = enable_cache and cacheable_temperature(self.temperature)
+        self.cache = LLMResponseCache(self.script_dir / ".llm_cache" / "suggest", enabled=enable_cache)
+        # Opt-in (RIAS_LLM_CACHE=1): also reuse replies for near-identical documents
+        self.semantic = (SemanticResponseCache(self.cache.cache_dir)
+                         if enable_cache and semantic_cache_enabled() else None)
+        self._cache_ns = None
+        self._prompt_cache_key = None
+        # Opt-in (RIAS_RELEVANT_CHUNKS=1): long papers send their most task-relevant chunks, not just the opening
+        self.embeddings = (EmbeddingCache(self.script_dir / ".llm_cache" / "embeddings")
+                           if relevant_chunks_enabled() else None)
+        self._query_vec = None
 
     # ------------------------------------------------------------------
     # Utility methods
     # ------------------------------------------------------------------
-    @staticmethod
-    def truncate_text(text: str, limit: int = 20_000) -> str:
-        """Truncate overly long text for model input."""
-        return text if len(text) <= limit else text[:limit] + "\n\n[Text truncated for LLM]"
-
     @staticmethod
     def format_for_excel(value):
         """Ensure structured values (lists, dicts) are readable in Excel."""
+        if type(value) is str: # Most cells; skip the container checks
+            return value
         if isinstance(value, list):
             return ", ".join(map(str, value))
         elif isinstance(value, dict):
-            return json.dumps(value, ensure_ascii=False)
+            return json_dumps(value).decode("utf-8")
         return value
 
     def load_prompt(self) -> str:
-        """Load the base prompt template."""
-        return self.prompt_path.read_text(encoding="utf-8")
+        """Load the base prompt template (read once per process while the file is unchanged)."""
+        return read_prompt(self.prompt_path)
 
     @staticmethod
     def clean_raw(raw: str) -> str:
-        """Strip Markdown code fences and JSON prefixes."""
-        raw = raw.strip()
-        if raw.startswith("```"):
-            parts = raw.split("```", 2)
-            raw = parts[1] if len(parts) > 1 else parts[0]
-        if raw.lower().startswith("json"):
-            raw = raw[4:].strip()
-        return raw
+        """Strip Markdown code fences and JSON prefixes (an unclosed fence keeps its payload)."""
+        return strip_json_fence(raw)
 
     # ------------------------------------------------------------------
     # LLM caller
     # ------------------------------------------------------------------
-    def call_llm(self, prompt_text: str) -> str:
+    async def call_llm(self, prompt_text: str, document_text: str = None) -> str:
         """Send prompt to GPT and return raw JSON string."""
+        key = LLMResponseCache.key(self.model, self.max_tokens, self.temperature, SUGGEST_SYSTEM_PROMPT, prompt_text)
+        cached = self.cache.get(key)
+        if cached is not None:
+            logger.info("♻️ Using cached LLM response.")
+            return cached
+
+        vector = None
+        if self.semantic is not None and document_text:
+            try:
+                emb = await self.client.embeddings.create(
+                    model=EMBED_MODEL, input=SemanticResponseCache.embed_input(document_text)
+                )
+                vector = emb.data[0].embedding
+                near_key = self.semantic.lookup(self._cache_ns, vector)
+                cached = self.cache.get(near_key) if near_key else None
+                if cached is not None:
+                    logger.info("♻️ Using cached LLM response for a near-identical document.")
+                    return cached
+            except Exception as e:
+                logger.warning(f"⚠️ Semantic cache lookup failed: {e}")
+
+        # An oversized prompt would fail on every attempt; reject it before the round-trip
+        prompt_tokens = count_tokens(SUGGEST_SYSTEM_PROMPT + prompt_text, self.model)
+        if prompt_tokens + self.max_tokens > self.context_window:
+            raise ValueError(
+                f"Prompt of {prompt_tokens} tokens plus {self.max_tokens} for the reply exceeds the "
+                f"{self.context_window}-token context window"
+            )
+
         messages = [
-            {"role": "system", "content": "You are an academic research assistant. Return only valid JSON."},
+            {"role": "system", "content": SUGGEST_SYSTEM_PROMPT},
             {"role": "user", "content": prompt_text},
         ]
 
         for attempt in range(1, self.max_retries + 1):
             try:
-                resp = self.client.chat.completions.create(
+                # Only the request itself holds a slot, not the backoff sleep
+                request = dict(
                     model=self.model,
                     messages=messages,
                     max_tokens=self.max_tokens,
                     temperature=self.temperature,
                     response_format={"type": "json_object"},
+                    prompt_cache_key=self._prompt_cache_key,
                 )
-                return resp.choices[0].message.content.strip()
+                await rate_limit_gate().wait_async() # Near the rate limit: wait for the window instead of a 429
+                async with self._llm_sem:
+                    if self._http is not None:
+                        content = await raw_chat_completion(self._http, **request)
+                    else:
+                        content = (await self.client.chat.completions.create(**request)).choices[0].message.content
+                content = content.strip()
+                self.cache.put(key, content)
+                if vector is not None and content:
+                    self.semantic.add(self._cache_ns, key, vector)
+                return content
             except Exception as e:
-                print(f"⚠️ Attempt {attempt}/{self.max_retries} failed: {e}")
+                logger.warning(f"⚠️ Attempt {attempt}/{self.max_retries} failed: {e}")
                 if attempt == self.max_retries:
                     raise
-                time.sleep(2 ** attempt)
+                await asyncio.sleep(retry_delay(e, attempt - 1))
         return ""
 
     # ------------------------------------------------------------------
     # Core logic
     # ------------------------------------------------------------------
     def process_txt_file(self, txt_path: Path, base_prompt: str):
-        """Generate paper suggestions for a single text file."""
-        print(f"\n📄 Processing {txt_path.name}")
-        full_text = txt_path.read_text(encoding="utf-8")
-        combined_prompt = base_prompt.replace("<<<DOCUMENT_TEXT>>>", self.truncate_text(full_text))
-
-        raw = self.call_llm(combined_prompt)
+        """Generate paper suggestions for a single text file (errors propagate to the caller)."""
+        result = asyncio.run(self._process_all([txt_path], base_prompt))[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def _process_one(self, txt_path: Path, prompt_parts: tuple) -> list:
+        logger.info(f"\n📄 Processing {txt_path.name}")
+        # prompt_parts is the template split once around the document marker (see split_prompt)
+        prefix, suffix = prompt_parts
+        text = await self._read_for_llm(txt_path)
+        raw = await self.call_llm(prefix + text + suffix, document_text=text)
+        return self.parse_suggestions(txt_path, raw)
+
+    async def _read_for_llm(self, txt_path: Path) -> str:
+        """The paper text sent to the LLM, read off the event loop so other requests keep flowing."""
+        if self._query_vec is not None and txt_path.stat().st_size > self.text_limit:
+            try:
+                return await self._relevant_text(txt_path)
+            except Exception as e:
+                logger.warning(f"⚠️ Relevance selection failed for {txt_path.name} ({e}); using its opening instead.")
+        # Only the part sent to the LLM is read
+        return await asyncio.to_thread(read_truncated_tokens, txt_path, self.text_tokens, self.model)
+
+    async def _embed(self, inputs: list) -> list:
+        async with self._llm_sem:
+            resp = await self.client.embeddings.create(model=EMBED_MODEL, input=inputs)
+        return [d.embedding for d in resp.data]
+
+    async def _relevant_text(self, txt_path: Path) -> str:
+        """The chunks of a long paper most similar to the task, within text_limit, in document order."""
+        text = await asyncio.to_thread(txt_path.read_text, encoding="utf-8")
+        if len(text) <= self.text_limit:
+            return text
+        chunks = split_chunks(text)
+        vectors = self.embeddings.get(chunks)
+        if vectors is None:
+            vectors = await self._embed(chunks)
+            self.embeddings.put(chunks, vectors)
+        budget = self.text_limit - len(TRUNCATION_NOTE)
+        return select_relevant(chunks, vectors, self._query_vec, budget) + TRUNCATION_NOTE
+
+    def _make_batches(self, txt_files: list) -> list:
+        """Group files into requests of up to batch_size papers, within batch_char_limit."""
+        batches, current, size = [], [], 0
+        for txt_path in txt_files:
+            est = min(txt_path.stat().st_size, self.text_limit)
+            if current and (len(current) >= self.batch_size or size + est > self.batch_char_limit):
+                batches.append(current)
+                current, size = [], 0
+            current.append(txt_path)
+            size += est
+        if current:
+            batches.append(current)
+        return batches
+
+    async def _process_batch(self, batch: list, prompt_parts: tuple) -> list:
+        """Suggestions for several files from one request; files missing from the reply are retried alone."""
+        if len(batch) == 1:
+            return await asyncio.gather(self._process_one(batch[0], prompt_parts), return_exceptions=True)
+
+        logger.info(f"\n📄 Processing {', '.join(p.name for p in batch)} in one request")
+        prefix, suffix = prompt_parts
+        texts = await asyncio.gather(*(self._read_for_llm(p) for p in batch))
+        docs = "\n\n".join(
+            f"=== FILE {i}: {p.name} ===\n{text}" for i, (p, text) in enumerate(zip(batch, texts), 1)
+        )
+        found = {}
+        try:
+            raw = await self.call_llm(prefix + docs + suffix + BATCH_INSTRUCTIONS)
+            data = json_loads(self.clean_raw(raw))
+            for entry in data.get("Results", []):
+                if isinstance(entry, dict) and isinstance(entry.get("Suggestions"), list):
+                    found[str(entry.get("Source File", ""))] = entry["Suggestions"]
+        except Exception as e:
+            logger.warning(f"⚠️ Batched request failed ({e}); falling back to one request per file.")
+
+        results = {}
+        for txt_path in batch:
+            if txt_path.name in found:
+                suggestions = found[txt_path.name]
+                for s in suggestions:
+                    s["Source File"] = txt_path.name
+                logger.info(f"✅ {len(suggestions)} suggestions found for {txt_path.name}")
+                results[txt_path] = suggestions
+        missing = [p for p in batch if p not in results]
+        singles = await asyncio.gather(*(self._process_one(p, prompt_parts) for p in missing), return_exceptions=True)
+        results.update(zip(missing, singles))
+        return [results[p] for p in batch]
+
+    async def _process_all(self, txt_files: list, base_prompt: str) -> list:
+        from openai import AsyncOpenAI # Imported on first use; the SDK is slow to load
+
+        prompt_parts = split_prompt(base_prompt) # Once per run, not once per file
+        # Near-match cache entries are only shared between identical models, settings and templates
+        self._cache_ns = LLMResponseCache.key(
+            self.model, self.max_tokens, self.temperature, SUGGEST_SYSTEM_PROMPT, *prompt_parts
+        )
+        # Requests sharing the system message and instructions are routed to the same prompt cache
+        self._prompt_cache_key = LLMResponseCache.key(SUGGEST_SYSTEM_PROMPT, prompt_parts[0])
+        self._llm_sem = asyncio.Semaphore(self.max_concurrency)
+        # Retries are handled in call_llm, so the SDK's own retries are disabled
+        http = openai_http_client(async_client=True)
+        self.client = AsyncOpenAI(http_client=http, max_retries=0)
+        # Same pooled connections either way; the client's close() also closes them
+        self._http = http if raw_http_enabled() else None
+        try:
+            if self.embeddings is not None:
+                try:
+                    # The instructions before the paper text describe the task chunks are ranked against
+                    self._query_vec = (await self._embed([prompt_parts[0]]))[0]
+                except Exception as e:
+                    logger.warning(f"⚠️ Could not embed the task description ({e}); sending paper openings instead.")
+            batches = await asyncio.gather(*(self._process_batch(b, prompt_parts) for b in self._make_batches(txt_files)))
+            return [result for batch in batches for result in batch]
+        finally:
+            await self.client.close()
+            self.client = None
+            self._http = None
+            self._query_vec = None
+
+    def process_txt_files(self, txt_files: list, base_prompt: str) -> list:
+        """Request suggestions for all files concurrently; returns one list per file, in file order."""
+        results = asyncio.run(self._process_all(txt_files, base_prompt))
+        for txt_path, result in zip(txt_files, results):
+            if isinstance(result, Exception):
+                logger.error(f"❌ Failed {txt_path.name}: {result}")
+        return [[] if isinstance(r, Exception) else r for r in results]
+
+    def parse_suggestions(self, txt_path: Path, raw: str) -> list:
+        """Parse the LLM reply for one file and tag each suggestion with its source."""
         cleaned = self.clean_raw(raw)
 
         try:
-            data = json.loads(cleaned)
+            data = json_loads(cleaned)
             suggestions = data.get("Suggestions", [])
             for s in suggestions:
                 s["Source File"] = txt_path.name
-            print(f"✅ {len(suggestions)} suggestions found for {txt_path.name}")
+            logger.info(f"✅ {len(suggestions)} suggestions found for {txt_path.name}")
             return suggestions
         except json.JSONDecodeError as e:
-            print(f"❌ JSON parse error for {txt_path.name}: {e}")
+            logger.error(f"❌ JSON parse error for {txt_path.name}: {e}")
             return []
 
     def save_to_excel(self, suggestions: list):
-        """Write suggestions to Excel with nice formatting."""
+        """Write suggestions to Excel, streaming rows through a write-only workbook."""
+        wb = new_write_only_workbook()
+        # Bold, frozen header row built from WriteOnlyCells once, like the comparison sheets
+        ws, _ = add_layout_sheet(wb, SUGGESTION_SHEET)
+
         if not suggestions:
-            print("⚠️ No suggestions to save.")
+            logger.warning("⚠️ No suggestions to save.")
             # Still save an empty file so the pipeline step is "successful"
-            wb = Workbook()
-            ws = wb.active
-            ws.title = "Suggested Papers"
-            ws.append(["Source File", "File Name", "Author", "Summary Information", "Keywords", "Reference Link"])
             ws.append(["No suggestions found."])
             wb.save(self.output_xlsx)
-            print(f"💾 Empty suggestions file saved to: {self.output_xlsx}")
+            logger.info(f"💾 Empty suggestions file saved to: {self.output_xlsx}")
             return
 
-        df = pd.DataFrame(suggestions)
-        columns = ["Source File", "File Name", "Author", "Summary Information", "Keywords", "Reference Link"]
-        # Ensure all columns exist, even if empty
-        for col in columns:
-            if col not in df.columns:
-                df[col] = ""
-                
-        df = df[columns] # Reorder
-
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Suggested Papers"
-        ws.append(columns)
-
-        for _, row in df.iterrows():
-            ws.append([self.format_for_excel(row.get(c, "")) for c in columns])
+        # One C-level itemgetter call per row; rows missing a field are padded with blanks first
+        rows = [_get_row(s) if _SUGGESTION_KEYS <= s.keys() else _get_row({**_BLANK_ROW, **s}) for s in suggestions]
+        # Format column by column: all-text columns (the usual case) are passed through untouched
+        columns = []
+        for col in zip(*rows):
+            if not all(type(v) is str for v in col):
+                col = map(self.format_for_excel, col)
+            columns.append(col)
+        for row in zip(*columns):
+            ws.append(row)
 
         wb.save(self.output_xlsx)
-        print(f"\n💾 Suggested papers saved to: {self.output_xlsx}")
+        logger.info(f"\n💾 Suggested papers saved to: {self.output_xlsx}")
 
     # ------------------------------------------------------------------
     # Runner (for standalone use)
@@ -193,26 +367,25 @@ class PaperSuggester:
     def run(self):
         """Main entry point for running the suggester in standalone mode."""
         try:
-            print("\n--- Starting paper suggestion process (standalone) ---")
+            logger.info("\n--- Starting paper suggestion process (standalone) ---")
             txt_files = sorted(self.txt_dir.glob("*.txt"))
             if not txt_files:
-                print("❌ No .txt files found in:", self.txt_dir)
+                logger.error(f"❌ No .txt files found in: {self.txt_dir}")
                 return
 
             base_prompt = self.load_prompt()
             all_suggestions = []
 
-            for txt_path in txt_files:
-                suggestions = self.process_txt_file(txt_path, base_prompt)
+            for suggestions in self.process_txt_files(txt_files, base_prompt):
                 all_suggestions.extend(suggestions)
 
             if not all_suggestions:
-                print("⚠️ No suggestions found.")
+                logger.warning("⚠️ No suggestions found.")
             
             self.save_to_excel(all_suggestions)
 
         except Exception as e:
-            print(f"ERROR: {e}")
+            logger.error(f"ERROR: {e}")
 
 
 # ----------------------------------------------------------------------
@@ -241,15 +414,16 @@ def run(pdf_path, out_dir, prev=None):
         if not prompt_path.exists():
             raise FileNotFoundError(f"Prompt file not found: {prompt_path}")
 
-        print(f"\nInput paths for suggestions {p.stem}:")
-        print(f"- Text file: {txt_file}")
-        print(f"- Output file: {output_file}")
+        logger.info(f"\nInput paths for suggestions {p.stem}:")
+        logger.info(f"- Text file: {txt_file}")
+        logger.info(f"- Output file: {output_file}")
 
         # 3. Initialize Suggester
         suggester = PaperSuggester(
             txt_dir=txt_file.parent, # Pass the directory
             prompt_path=prompt_path,
-            output_xlsx=output_file  # Pass the specific output file
+            output_xlsx=output_file,  # Pass the specific output file
+            log_dir=out.parent.parent.parent / "logs", # Session-wide logs folder
         )
 
         # 4. Process the single paper
@@ -268,8 +442,7 @@ def run(pdf_path, out_dir, prev=None):
 
     except Exception as e:
         import traceback
-        print(f"ERROR in suggest_papers: {e}")
-        traceback.print_exc()
+        logger.error(f"ERROR in suggest_papers: {e}\n{traceback.format_exc()}")
         return {"status": "error", "error": str(e)}
 
 
@@ -278,7 +451,7 @@ def run(pdf_path, out_dir, prev=None):
 # ----------------------------------------------------------------------
 if __name__ == "__main__":
     # --- Example paths for direct testing ---
-    print("Running PaperSuggester in standalone mode...")
+    logger.info("Running PaperSuggester in standalone mode...")
     
     SCRIPT_DIR = Path(__file__).resolve().parent.parent 
     
@@ -294,6 +467,5 @@ if __name__ == "__main__":
         )
         suggester.run() # This calls the class's run() method
     except Exception as e:
-        print(f"Error during standalone test: {e}")
         import traceback
-        traceback.print_exc()
+        logger.error(f"Error during standalone test: {e}\n{traceback.format_exc()}")
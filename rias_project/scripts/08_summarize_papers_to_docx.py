@@ -1,28 +1,158 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import json
-import sys
+import asyncio
+import copy
+import re
 import datetime
+import io
+import os
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
 from pathlib import Path
 from dotenv import load_dotenv
-from openai import OpenAI
 from docx import Document
 from docx.shared import Pt, Inches
 from docx.enum.text import WD_ALIGN_PARAGRAPH
+from docx.oxml import OxmlElement
+from docx.oxml.shape import CT_Inline
+from docx.oxml.table import CT_Tbl
+from docx.table import Table
+from docx.text.paragraph import Paragraph
+from utils import (
+    CHARS_PER_TOKEN, EMBED_MODEL, IMAGE_ALIASES_FILE, LLMResponseCache, SemanticResponseCache, batch_api_enabled, cacheable_temperature, semantic_cache_enabled,
+    attach_log_file, count_tokens, forget_files, get_logger, json_dumps, json_loads, log_prompt_cache, openai_http_client, rate_limit_gate, read_file_bytes, read_prompt, read_truncated, retry_delay,
+    shared_openai_http_client,
+    split_prompt, truncate_tokens,
+)
+
+logger = get_logger("rias.summary")
+
+SUMMARY_SYSTEM_PROMPT = (
+    "You are an academic summarizer and document restorer. "
+    "You MUST output only valid JSON with this schema:\n"
+    "{ \"SummaryDoc\": \"<full reconstructed academic document text including figure markers>\" }"
+)
+# Appended after the documents when several text files share one request
+SUMMARY_BATCH_INSTRUCTIONS = (
+    "\n\nThe document text above contains several files, each starting with a line '=== FILE n: <name> ==='. "
+    "Summarize each file separately and, instead of a single SummaryDoc, return valid JSON of the form "
+    '{"Summaries": [{"file": "<name>", "SummaryDoc": "..."}]} with one entry per file.'
+)
+
+# Compiled once; _repair runs on every malformed reply
+_FENCE_RE = re.compile(r"```(?:json)?", re.IGNORECASE)
+_UNQUOTED_KEY_RE = re.compile(r'([{,])\s*([A-Za-z_][A-Za-z0-9_]*)\s*:')
+# Blocks are runs of text separated by blank lines ("\n\n"); each is classified by one anchored match
+# Heading level/text or figure payload, captured in the same match that classifies the block;
+# lastgroup names the kind (the outer group of each alternative closes last)
+_BLOCK_RE = re.compile(
+    r"(?P<heading>(?P<h>#+)[# ]*(?P<htxt>.*))|(?P<figure>\[\[FIGURE:\s*(?P<fig>.*?)\]*)|(?P<table>\|.*)",
+    re.DOTALL,
+)
+# Alignment row of a Markdown table (|:---|---:|:---:|)
+_TABLE_RULE_RE = re.compile(r"\s*:?-+:?\s*")
+_FIGURE_NAME_RE = re.compile(r"\[\[FIGURE:([^|\]]+)")
+_IMG_EXTS = frozenset({".png", ".jpg", ".jpeg", ".tif", ".bmp", ".svg"})
+# pageX_imgY names written by 06_extract_images (page and image numbers sort the figures list)
+_PAGE_IMG_RE = re.compile(r"page(\d+)_img(\d+)", re.IGNORECASE)
+
+
+def _iter_blocks(text: str):
+    """Yield the blank-line-separated blocks of text one at a time (no list of every block is built)."""
+    start = 0
+    end = text.find("\n\n")
+    while end != -1:
+        yield text[start:end]
+        start = end + 2
+        end = text.find("\n\n", start)
+    yield text[start:]
 
 
 # ---------------------------------------------------------------------
-# Logging setup helper
+# Streaming: build the DOCX while the reply is generated
 # ---------------------------------------------------------------------
-class Tee:
-    def __init__(self, *files): self.files = files
-    def write(self, obj):
-        for f in self.files:
-            f.write(obj); f.flush()
-    def flush(self):
-        for f in self.files: f.flush()
+class SummaryDocStream:
+    """
+    Decodes the SummaryDoc string of a streamed JSON reply as it arrives and appends
+    each completed blank-line-separated block to a fresh document. Only the current
+    block and a few undecoded characters are held, never the whole reply text.
+    """
+
+    _KEY_RE = re.compile(r'"SummaryDoc"\s*:\s*"')
+    _SPECIAL_RE = re.compile(r'["\\]')
+    _ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+    def __init__(self, open_doc, append_block):
+        self._open_doc = open_doc
+        self._append_block = append_block
+        self.reset()
+
+    def reset(self):
+        """Start over with an empty document (a retried request streams its reply again)."""
+        self.doc = self._open_doc()
+        self.complete = False
+        self._failed = False
+        self._head = ""       # Reply text before the SummaryDoc value starts
+        self._pending = None  # Undecoded tail of the value (an escape split across deltas)
+        self._text = ""       # Decoded text of the unfinished block
+
+    def feed(self, delta: str):
+        if self.complete or self._failed:
+            return
+        try:
+            if self._pending is None:
+                self._head += delta
+                m = self._KEY_RE.search(self._head)
+                if not m:
+                    return
+                raw, self._head = self._head[m.end():], ""
+            else:
+                raw = self._pending + delta
+            decoded, self._pending = self._decode(raw)
+        except ValueError:
+            self._failed = True # Malformed escape: the caller falls back to building from the full reply
+            return
+        *blocks, self._text = (self._text + decoded).split("\n\n")
+        for block in blocks:
+            self._append_block(self.doc, block)
+        if self.complete:
+            self._append_block(self.doc, self._text)
+            self._text = ""
+
+    def _decode(self, raw: str) -> tuple:
+        """(decoded text, undecoded remainder) of JSON string content, up to the closing quote."""
+        out, i, n = [], 0, len(raw)
+        while True:
+            m = self._SPECIAL_RE.search(raw, i)
+            if m is None:
+                out.append(raw[i:])
+                return "".join(out), ""
+            j = m.start()
+            out.append(raw[i:j])
+            if raw[j] == '"':
+                self.complete = True
+                return "".join(out), ""
+            if j + 1 >= n:
+                return "".join(out), raw[j:]
+            if raw[j + 1] != "u":
+                out.append(self._ESCAPES.get(raw[j + 1], raw[j + 1]))
+                i = j + 2
+                continue
+            if j + 6 > n:
+                return "".join(out), raw[j:]
+            code = int(raw[j + 2:j + 6], 16)
+            i = j + 6
+            if 0xD800 <= code < 0xDC00: # High surrogate; the low half follows as a second \\uXXXX
+                if j + 12 > n:
+                    return "".join(out), raw[j:]
+                if raw[j + 6:j + 8] != "\\u":
+                    raise ValueError("unpaired surrogate")
+                code = 0x10000 + ((code - 0xD800) << 10) + (int(raw[j + 8:j + 12], 16) - 0xDC00)
+                i = j + 12
+            out.append(chr(code))
 
 
 # ---------------------------------------------------------------------
@@ -38,12 +168,37 @@ class PaperSummarizer:
         model="gpt-5",
         max_tokens=20000,
         max_retries=3,
+        temperature=None,
+        enable_cache=True,
+        section_workers=1,
+        log_dir=None,
+        context_window=128_000,
+        use_batch=False,
+        batch_size=1,
+        stream_docx=False,
     ):
         load_dotenv()
-        self.client = OpenAI()
+        # The async client and request semaphore are created per run, inside the event loop that uses them
+        self.client = None
+        self._llm_sem = None
         self.model = model
         self.max_tokens = max_tokens
         self.max_retries = max_retries
+        # None leaves it to the API (1.0, the only value reasoning models accept); replies are then not cached
+        self.temperature = temperature
+        self.context_window = context_window
+        # Submit through the Batch API and wait for it (up to 24h) instead of calling the API directly
+        self.use_batch = use_batch
+        # Text files packed into one request (instructions and a rate-limit slot shared). Off by default:
+        # every file's summary counts against the same max_tokens reply
+        self.batch_size = batch_size
+        # Stream the reply and add DOCX blocks as they complete (single-request summaries only)
+        self.stream_docx = stream_docx
+        self._streamed_doc = None
+        # Requests in flight when a paper was extracted into several text files. The default (1) sends
+        # them as one combined request and gets one combined summary; > 1 is opt-in and summarizes each
+        # file separately, joining the summaries in file order
+        self.section_workers = section_workers
 
         self.txt_dir = Path(txt_dir)
         self.images_dir = Path(images_dir)
@@ -54,52 +209,62 @@ class PaperSummarizer:
         # Setup logging
         timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
         script_dir = Path(__file__).resolve().parent.parent
-        log_dir = script_dir / "logs"
-        log_dir.mkdir(exist_ok=True)
+        log_dir = Path(log_dir or os.getenv("RIAS_LOG_DIR") or script_dir / "logs")
+        log_dir.mkdir(parents=True, exist_ok=True)
         log_file = log_dir / f"summary_log_{timestamp}.txt"
-        log_f = open(log_file, "w", encoding="utf-8")
-        sys.stdout = Tee(sys.__stdout__, log_f)
-        sys.stderr = Tee(sys.__stderr__, log_f)
+
+        # Re-runs on unchanged text reuse the stored reply (only for a pinned, near-deterministic temperature);
+        # RIAS_LLM_CACHE=1 also matches near-identical text
+        enable_cache = enable_cache and temperature is not None and cacheable_temperature(temperature)
+        self.cache = LLMResponseCache(script_dir / ".llm_cache" / "summary", enabled=enable_cache)
+        self.semantic = (SemanticResponseCache(self.cache.cache_dir)
+                         if enable_cache and semantic_cache_enabled() else None)
+        # Console + log file through the module logger (no stdout redirection)
+        attach_log_file(logger, log_file)
         self.log_file = log_file
 
     # ------------------------------------------------------------------
     # Utility methods
     # ------------------------------------------------------------------
-    def truncate_text(self, text: str, limit: int = 30_000) -> str:
-        return text if len(text) <= limit else text[:limit] + "\n\n[Text truncated for LLM]"
+    def truncate_text(self, text: str, max_tokens: int) -> str:
+        return truncate_tokens(text, max_tokens, self.model) # By tokens, so dense or CJK text cannot overflow
 
     def load_prompt(self) -> str:
-        return self.prompt_path.read_text(encoding="utf-8")
+        return read_prompt(self.prompt_path) # Cached per process until the file changes
 
-    def clean_raw(self, raw: str) -> str:
-        """Clean malformed JSON response from LLM."""
+    @staticmethod
+    def try_parse(raw: str):
+        """Parse an LLM reply into a dict, or return None if it is not a JSON object."""
+        try:
+            parsed = json_loads(raw)
+        except (ValueError, TypeError):
+            return None
+        return parsed if isinstance(parsed, dict) else None
+
+    def _repair(self, raw: str) -> str:
+        """Best-effort fixes for a malformed JSON reply (only used when try_parse fails)."""
         try:
             # Basic string cleaning
             raw = raw.strip()
-            
-            # If it's already valid JSON, return it
-            try:
-                json.loads(raw)
-                return raw
-            except:
-                pass
 
             # Remove any markdown code block markers
-            raw = raw.replace("```json", "").replace("```", "")
+            if "```" in raw:
+                raw = _FENCE_RE.sub("", raw).strip()
+                # A fenced but otherwise valid reply needs none of the lossy fixes below
+                if self.try_parse(raw) is not None:
+                    return raw
             
             # Ensure it starts/ends with curly braces
             if not raw.startswith("{"): raw = "{" + raw
             if not raw.endswith("}"): raw = raw + "}"
             
-            # Fix common JSON formatting issues
-            raw = raw.replace('""', '"')
-            raw = raw.replace('}"', '}')
-            raw = raw.replace('"{', '{')
-            raw = raw.replace('\n', ' ')
+            # Fix common JSON formatting issues (each pass only when its pattern occurs)
+            for bad, good in (('""', '"'), ('}"', '}'), ('"{', '{'), ('\n', ' ')):
+                if bad in raw:
+                    raw = raw.replace(bad, good)
             
             # Add quotes around property names if missing
-            import re
-            raw = re.sub(r'([{,])\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*:', r'\1"\2":', raw)
+            raw = _UNQUOTED_KEY_RE.sub(r'\1"\2":', raw)
             
             # If no SummaryDoc key exists, wrap the entire content
             if '"SummaryDoc"' not in raw:
@@ -108,49 +273,89 @@ class PaperSummarizer:
             return raw
             
         except Exception as e:
-            print(f"Failed to clean JSON: {e}")
+            logger.warning(f"Failed to clean JSON: {e}")
             # Return a minimal valid JSON as fallback
             return '{"SummaryDoc": "Error parsing LLM response"}'
 
     # ------------------------------------------------------------------
     # LLM call
     # ------------------------------------------------------------------
-    def call_llm(self, prompt: str) -> str:
+    async def call_llm(self, prompt: str, document_text: str = None, stream: SummaryDocStream = None) -> str:
         """Call GPT model and ensure valid JSON output."""
-        system_msg = {
-            "role": "system",
-            "content": (
-                "You are an academic summarizer and document restorer. "
-                "You MUST output only valid JSON with this schema:\n"
-                "{ \"SummaryDoc\": \"<full reconstructed academic document text including figure markers>\" }"
-            ),
-        }
+        key = LLMResponseCache.key(self.model, self.max_tokens, self.temperature, SUMMARY_SYSTEM_PROMPT, prompt)
+        cached = self.cache.get(key)
+        if cached is not None:
+            logger.info("Using cached LLM response.")
+            return cached
+
+        vector = None
+        namespace = LLMResponseCache.key(self.model, self.max_tokens, self.temperature, SUMMARY_SYSTEM_PROMPT, self.load_prompt())
+        if self.semantic is not None and document_text:
+            try:
+                emb = await self.client.embeddings.create(
+                    model=EMBED_MODEL, input=SemanticResponseCache.embed_input(document_text)
+                )
+                vector = emb.data[0].embedding
+                near_key = self.semantic.lookup(namespace, vector)
+                cached = self.cache.get(near_key) if near_key else None
+                if cached is not None:
+                    logger.info("Using cached LLM response for a near-identical document.")
+                    return cached
+            except Exception as e:
+                logger.warning(f"⚠️ Semantic cache lookup failed: {e}")
 
+        system_msg = {"role": "system", "content": SUMMARY_SYSTEM_PROMPT}
         user_msg = {"role": "user", "content": prompt}
+        cache_key = self._prompt_cache_key()
 
         for attempt in range(self.max_retries):
             try:
-                resp = self.client.chat.completions.create(
+                request = dict(
                     model=self.model,
                     messages=[system_msg, user_msg],
                     max_completion_tokens=self.max_tokens,
                     response_format={"type": "json_object"},
+                    prompt_cache_key=cache_key,
+                    **self._sampling(),
                 )
-
-                choice = resp.choices[0]
-                content = getattr(choice.message, "content", None)
-                if not content:
-                    print("⚠️ Empty content field from LLM.")
+                await rate_limit_gate().wait_async() # Near the rate limit: wait for the window instead of a 429
+                # Only the request itself holds a slot, not the backoff sleep
+                async with self._llm_sem:
+                    if stream is None:
+                        resp = await self.client.chat.completions.create(**request)
+                        content = getattr(resp.choices[0].message, "content", None)
+                        usage = getattr(resp, "usage", None)
+                    else:
+                        stream.reset()
+                        deltas, usage = [], None
+                        async for chunk in await self.client.chat.completions.create(
+                            **request, stream=True, stream_options={"include_usage": True}
+                        ):
+                            delta = chunk.choices[0].delta.content if chunk.choices else None
+                            if delta:
+                                deltas.append(delta)
+                                stream.feed(delta)
+                            usage = getattr(chunk, "usage", None) or usage # Sent with the last chunk
+                        content = "".join(deltas)
+                # The system message and instruction prefix are identical across papers; this shows whether they hit
+                log_prompt_cache(logger, usage)
+
+                if not content or content.isspace():
+                    logger.warning("⚠️ Empty content field from LLM.")
                     continue
 
-                cleaned = self.clean_raw(content)
-                return cleaned.strip()
+                # Stored as received (JSON mode: no fences, and the parser skips surrounding whitespace);
+                # run() parses it once and only repairs it if that fails
+                self.cache.put(key, content)
+                if vector is not None:
+                    self.semantic.add(namespace, key, vector)
+                return content
 
             except Exception as e:
-                print(f"Attempt {attempt+1}/{self.max_retries} failed: {e}")
+                logger.warning(f"Attempt {attempt+1}/{self.max_retries} failed: {e}")
                 if attempt == self.max_retries - 1:
                     raise
-                time.sleep(2 ** attempt)
+                await asyncio.sleep(retry_delay(e, attempt))
         return ""
 
     # ------------------------------------------------------------------
@@ -163,118 +368,521 @@ class PaperSummarizer:
             style.font.size = Pt(10)
             style.font.italic = True
 
-    def insert_image(self, doc: Document, img_path: Path, caption: str):
+    def insert_image(self, doc: Document, img_path: Path, caption: str, data: bytes = None, caption_style="Caption"):
         try:
-            p_img = doc.add_paragraph()
+            p_img = self._add_paragraph(doc)
             p_img.alignment = WD_ALIGN_PARAGRAPH.CENTER
             run = p_img.add_run()
-            run.add_picture(str(img_path), width=Inches(5.5))
-
-            p_cap = doc.add_paragraph(caption, style="Caption")
+            pic = self._pictures.get(img_path)
+            if pic is None:
+                # Preloaded bytes (see create_docx) skip opening the file here
+                if data is None:
+                    data = read_file_bytes(img_path)
+                rId, image = doc.part.get_or_add_image(io.BytesIO(data))
+                pic = self._pictures[img_path] = (rId, image.filename, *image.scaled_dimensions(Inches(5.5), None))
+            # A figure seen before reuses its image relationship instead of re-reading, hashing
+            # and matching the picture against every image part already in the document
+            rId, name, cx, cy = pic
+            # Shape ids are counted here; run.add_picture rescans every id in the document for each one
+            self._next_shape_id += 1
+            run._r.add_drawing(CT_Inline.new_pic_inline(self._next_shape_id - 1, rId, name, cx, cy))
+
+            p_cap = self._add_paragraph(doc, caption, caption_style)
             p_cap.alignment = WD_ALIGN_PARAGRAPH.CENTER
             for run_cap in p_cap.runs:
                 run_cap.italic = True
-            doc.add_paragraph()
+            self._add_paragraph(doc)
         except Exception as e:
-            print(f"Could not insert image {img_path.name}: {e}")
-
-    def create_docx(self, summary_text: str):
+            logger.warning(f"Could not insert image {img_path.name}: {e}")
+
+    @cached_property
+    def image_maps(self) -> tuple:
+        """
+        (by lowercased file name, by lowercased stem) for the extracted images; scanned once
+        and shared by the prompt's figures list and create_docx. A missing images folder
+        (run() only warns) gives empty maps.
+        """
+        by_name, by_stem = {}, {}
+        if not self.images_dir.is_dir():
+            return by_name, by_stem
+        for name in self._image_names():
+            path = self.images_dir / name
+            by_name[name.lower()] = path
+            by_stem.setdefault(os.path.splitext(name)[0].lower(), path)
+        return by_name, by_stem
+
+    @cached_property
+    def image_aliases(self) -> dict:
+        """
+        Lowercased names (and stems) of repeated images 06_extract_images skipped -> the name it
+        wrote instead.
+        """
+        try:
+            aliases = json_loads((self.images_dir / IMAGE_ALIASES_FILE).read_bytes())
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            logger.warning(f"⚠️ Ignoring unreadable {IMAGE_ALIASES_FILE}: {e}")
+            return {}
+        by_name = {}
+        for name, first in (aliases.items() if isinstance(aliases, dict) else ()):
+            name = str(name).lower()
+            by_name[name] = str(first)
+            by_name.setdefault(os.path.splitext(name)[0], str(first))
+        return by_name
+
+    def _image_names(self) -> list:
+        """Image file names in images_dir (one scandir pass)."""
+        with os.scandir(self.images_dir) as it:
+            return [e.name for e in it if os.path.splitext(e.name)[1].lower() in _IMG_EXTS and e.is_file()]
+
+    @cached_property
+    def figures_list(self) -> str:
+        """
+        The <<<FIGURES_LIST>>> section of the prompt: one line per extracted image in page order.
+        Sent after the paper text so the instruction prefix stays identical across papers.
+        """
+        names = sorted(
+            (path.name for path in self.image_maps[0].values()),
+            key=lambda n: tuple(map(int, m.groups())) if (m := _PAGE_IMG_RE.search(n)) else (0, 0),
+        )
+        if not names:
+            return ""
+        lines = []
+        for name in names:
+            m = _PAGE_IMG_RE.search(name)
+            lines.append(f"- {name} (PDF p.{m.group(1)})" if m else f"- {name}")
+        return "\n\n### FIGURES_LIST\n" + "\n".join(lines) + "\n"
+
+    def _resolve_image(self, filename: str):
+        """Path of the extracted image a figure marker refers to, or None."""
+        image_map, image_stem_map = self.image_maps
+        img_key = Path(filename.strip()).name.lower()
+        # A repeated image was written once; its other names point at that file
+        img_key = (self.image_aliases.get(img_key) or self.image_aliases.get(Path(img_key).stem) or img_key).lower()
+        # The LLM sometimes changes the extension (e.g. .jpg for a masked .png); fall back to the stem
+        return image_map.get(img_key) or image_stem_map.get(Path(img_key).stem)
+
+    def _preload_images(self, summary_text: str) -> dict:
+        """Read every image the summary refers to in parallel, once each (path -> bytes)."""
+        names = _FIGURE_NAME_RE.findall(summary_text)
+        if not names:
+            return {} # No figure markers: no image is read
+        logger.info(f"Found {len(self.image_maps[0])} images in {self.images_dir}")
+        paths = {self._resolve_image(name) for name in names}
+        paths.discard(None)
+        if not paths:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(8, len(paths))) as ex:
+            # Images extracted earlier in this process are handed over without a disk read
+            return dict(zip(paths, ex.map(read_file_bytes, paths)))
+
+    @cached_property
+    def _template_doc(self) -> Document:
+        """Empty document with the summary styles set up; parsed and styled once per summarizer."""
         doc = Document()
         normal = doc.styles["Normal"]
         normal.font.name = "Times New Roman"
         normal.font.size = Pt(12)
-
         self.ensure_caption_style(doc)
-
-        image_map = {
-            p.name.lower(): p for p in self.images_dir.iterdir()
-            if p.suffix.lower() in {".png", ".jpg", ".jpeg", ".tif", ".bmp", ".svg"}
+        return doc
+
+    def open_docx(self) -> Document:
+        """A new, styled summary document (append blocks with append_block, then save_docx)."""
+        # A copy of the template skips re-reading the default .docx package and redoing the style setup
+        doc = copy.deepcopy(self._template_doc)
+        self._pictures = {} # image path -> (rId, name, cx, cy) of its first insert in this document
+        self._next_shape_id = doc.part.next_id
+        # Style ids resolved by name once; add_paragraph/add_heading would look them up for every block
+        # (Normal is the default paragraph style, which python-docx leaves unset)
+        self._styles = {
+            "normal": None,
+            "caption": doc.styles["Caption"].style_id,
+            "table": doc.styles["Table Grid"].style_id,
+            **{level: doc.styles[f"Heading {level}"].style_id for level in (1, 2, 3)},
         }
+        # New blocks go right before the body's closing sectPr, found here once; doc.add_paragraph
+        # and doc.add_table search the whole body for it on every call, which is quadratic
+        body = doc.element.body
+        sect_pr = body.sectPr
+        self._insert_block = sect_pr.addprevious if sect_pr is not None else body.append
+        self._block_width = doc._block_width
+        return doc
+
+    def _add_paragraph(self, doc: Document, text: str = "", style_id: str = None) -> Paragraph:
+        """doc.add_paragraph(text, style) for the block-by-block build (see open_docx)."""
+        p = OxmlElement("w:p")
+        if style_id is not None:
+            p.style = style_id
+        self._insert_block(p)
+        paragraph = Paragraph(p, doc._body)
+        if text:
+            paragraph.add_run(text)
+        return paragraph
+
+    def _add_table(self, doc: Document, rows: int, cols: int, style_id: str) -> Table:
+        """doc.add_table(rows, cols) with a table style, inserted like _add_paragraph."""
+        tbl = CT_Tbl.new_tbl(rows, cols, self._block_width)
+        tbl.tblStyle_val = style_id
+        self._insert_block(tbl)
+        return Table(tbl, doc._body)
+
+    def append_block(self, doc: Document, block: str, image_bytes: dict = None):
+        """Add one blank-line-separated block of the summary (heading, figure marker, table or paragraph)."""
+        line = block.strip()
+        if not line:
+            return
+        m = _BLOCK_RE.fullmatch(line)
+        if m is None:
+            self._add_paragraph(doc, line, self._styles["normal"])
+        else:
+            self._block_handlers[m.lastgroup](doc, line, m, image_bytes)
 
-        print(f"Found {len(image_map)} images in {self.images_dir}")
+    @cached_property
+    def _block_handlers(self) -> dict:
+        return {"heading": self._add_heading_block, "figure": self._add_figure_block, "table": self._add_table_block}
 
-        blocks = [b.strip() for b in summary_text.split("\n\n") if b.strip()]
+    def _add_heading_block(self, doc: Document, line: str, m, image_bytes=None):
+        # "####" and deeper render as level 3, as before
+        self._add_paragraph(doc, m["htxt"].strip(), self._styles[min(len(m["h"]), 3)])
 
-        for block in blocks:
-            line = block.strip()
-
-            if line.startswith("###"):
-                doc.add_heading(line.lstrip("# ").strip(), level=3)
-            elif line.startswith("##"):
-                doc.add_heading(line.lstrip("# ").strip(), level=2)
-            elif line.startswith("#"):
-                doc.add_heading(line.lstrip("# ").strip(), level=1)
-            elif line.startswith("[[FIGURE:"):
-                try:
-                    inner = line.strip("[]").replace("FIGURE:", "").strip()
-                    parts = [p.strip() for p in inner.split("|")]
-                    filename = parts[0]
-                    caption = " | ".join(parts[1:])
-                    img_key = Path(filename).name.lower()
-
-                    if img_key in image_map:
-                        self.insert_image(doc, image_map[img_key], caption)
-                        print(f"Inserted image: {filename}")
-                    else:
-                        print(f"Image NOT FOUND: {filename}")
-                        p = doc.add_paragraph(f"[Image missing: {filename}] {caption}", style="Normal")
-                        p.alignment = WD_ALIGN_PARAGRAPH.CENTER
-                except Exception as e:
-                    print(f"Figure parsing error: {e}\n   Block: {line}")
-                    doc.add_paragraph(line, style="Normal")
+    def _add_figure_block(self, doc: Document, line: str, m, image_bytes=None):
+        styles = self._styles
+        try:
+            filename, _, caption = m["fig"].partition("|")
+            filename, caption = filename.strip(), caption.strip()
+            img_path = self._resolve_image(filename)
+
+            if img_path is not None:
+                data = image_bytes.get(img_path) if image_bytes else None
+                self.insert_image(doc, img_path, caption, data, styles["caption"])
+                logger.info(f"Inserted image: {filename}")
             else:
-                doc.add_paragraph(line, style="Normal")
-
+                logger.warning(f"Image NOT FOUND: {filename}")
+                p = self._add_paragraph(doc, f"[Image missing: {filename}] {caption}", styles["normal"])
+                p.alignment = WD_ALIGN_PARAGRAPH.CENTER
+        except Exception as e:
+            logger.warning(f"Figure parsing error: {e}\n   Block: {line}")
+            self._add_paragraph(doc, line, styles["normal"])
+
+    def _add_table_block(self, doc: Document, line: str, m, image_bytes=None):
+        """A Markdown pipe table as a Word table; the |:---| row sets column alignment."""
+        rows = []
+        for row in line.splitlines():
+            row = row.strip()
+            if not row.startswith("|"):
+                # Not a plain table (e.g. text mixed in): keep the block as written
+                self._add_paragraph(doc, line, self._styles["normal"])
+                return
+            row = row[1:-1] if row.endswith("|") and len(row) > 1 else row[1:]
+            rows.append([cell.strip() for cell in row.split("|")])
+
+        align = []
+        if len(rows) > 1 and all(_TABLE_RULE_RE.fullmatch(cell) for cell in rows[1]):
+            align = [
+                WD_ALIGN_PARAGRAPH.CENTER if c.startswith(":") and c.endswith(":")
+                else WD_ALIGN_PARAGRAPH.RIGHT if c.endswith(":") else None
+                for c in (cell.strip() for cell in rows.pop(1))
+            ]
+
+        ncols = max(map(len, rows))
+        table = self._add_table(doc, len(rows), ncols, self._styles["table"])
+        # All cells are read once and sliced per row; table.rows[i] re-walks the row list on every access
+        cells = table._cells
+        for i, row in enumerate(rows):
+            for j, (cell, text) in enumerate(zip(cells[i * ncols:(i + 1) * ncols], row)):
+                para = cell.paragraphs[0]
+                # Header row and **value** cells (the prompt bolds best results) are bold
+                marked = len(text) > 4 and text.startswith("**") and text.endswith("**")
+                para.add_run(text[2:-2] if marked else text).bold = (i == 0 or marked) or None
+                if j < len(align) and align[j] is not None:
+                    para.alignment = align[j]
+
+    def save_docx(self, doc: Document):
         doc.save(self.output_path)
-        print(f"💾 DOCX saved → {self.output_path}")
+        logger.info(f"💾 DOCX saved → {self.output_path}")
+
+    def create_docx(self, summary_text: str):
+        doc = self.open_docx()
+        image_bytes = self._preload_images(summary_text)
+        for block in _iter_blocks(summary_text):
+            self.append_block(doc, block, image_bytes)
+        self.save_docx(doc)
 
     # ------------------------------------------------------------------
     # Main runner
     # ------------------------------------------------------------------
+    def _build_prompt(self, sections: list, packed: bool = False) -> tuple:
+        """
+        (prompt, document text) for (file name, text) sections, cut to fit the context window.
+        packed: the files are numbered and the reply is asked for one summary per file.
+        """
+        if packed:
+            combined = "\n\n".join(f"=== FILE {i}: {name} ===\n{text}" for i, (name, text) in enumerate(sections, 1))
+        else:
+            combined = "\n\n".join(f"--- FILE: {name} ---\n{text}" for name, text in sections)
+        instructions = self.figures_list + (SUMMARY_BATCH_INSTRUCTIONS if packed else "")
+
+        # Call LLM with retry on JSON error
+        # Static instructions first, paper text last, so OpenAI's prompt-prefix cache can apply
+        prefix, suffix = split_prompt(self.load_prompt())
+        # Only text that fits next to the instructions and the reply is sent; an oversized prompt fails every retry
+        overhead = count_tokens(SUMMARY_SYSTEM_PROMPT + prefix + suffix + instructions, self.model)
+        budget = self.context_window - self.max_tokens - overhead
+        if budget <= 0:
+            raise ValueError(f"max_tokens={self.max_tokens} leaves no room for the paper in a {self.context_window}-token context")
+        combined = self.truncate_text(combined, budget)
+        return prefix + combined + suffix + instructions, combined
+
+    def _sampling(self) -> dict:
+        """The temperature, when one is pinned, for every request (direct and batch)."""
+        return {} if self.temperature is None else {"temperature": self.temperature}
+
+    def _prompt_cache_key(self) -> str:
+        """
+        Same value for every request sharing the system message and instruction prefix, so OpenAI
+        routes them to servers that already hold that prefix in their prompt cache.
+        """
+        prefix, _ = split_prompt(self.load_prompt())
+        return LLMResponseCache.key(SUMMARY_SYSTEM_PROMPT, prefix)
+
+    # Parsed per-file summaries, content-addressed, so a packed request only carries files not seen before
+    def _summary_key(self, name: str, text: str) -> str:
+        return LLMResponseCache.key(
+            "summary", self.model, self.max_tokens, self.temperature, self.context_window, SUMMARY_SYSTEM_PROMPT, self.load_prompt(), self.figures_list, name, text
+        )
+
+    def _cached_summary(self, name: str, text: str):
+        cached = self.cache.get(self._summary_key(name, text))
+        return json_loads(cached)["SummaryDoc"] if cached is not None else None
+
+    def _store_summary(self, name: str, text: str, summary: str):
+        if summary:
+            self.cache.put(self._summary_key(name, text), json_dumps({"SummaryDoc": summary}).decode("utf-8"))
+
+    def _parse_summary(self, raw: str) -> str:
+        """The SummaryDoc text of an LLM reply."""
+        if not raw:
+            raise ValueError("Empty response from LLM")
+
+        # Parse once; the repair heuristics only run on a malformed reply
+        parsed = self.try_parse(raw) or self.try_parse(self._repair(raw))
+        if parsed is None:
+            logger.warning("Failed to parse JSON even after cleaning")
+            # Create minimal valid response
+            parsed = {"SummaryDoc": raw}
+        return parsed.get("SummaryDoc", "").strip()
+
+    async def _summarize(self, sections: list) -> str:
+        """Summarize (file name, text) sections in one request and return the SummaryDoc text."""
+        # Tokenizing and truncating a long paper is CPU work; keep it off the event loop
+        prompt, combined = await asyncio.to_thread(self._build_prompt, sections)
+        summary = self._parse_summary(await self.call_llm(prompt, document_text=combined))
+        if len(sections) == 1:
+            self._store_summary(*sections[0], summary)
+        return summary
+
+    async def _summarize_streaming(self, sections: list) -> str:
+        """Like _summarize, but the DOCX is built from the reply as it streams in (see SummaryDocStream)."""
+        prompt, combined = await asyncio.to_thread(self._build_prompt, sections)
+        stream = SummaryDocStream(self.open_docx, self.append_block)
+        summary = self._parse_summary(await self.call_llm(prompt, document_text=combined, stream=stream))
+        # A cached reply never streams, and a malformed one is repaired first; both use create_docx instead
+        if stream.complete:
+            self._streamed_doc = stream.doc
+        return summary
+
+    def _read_paper(self, path: Path) -> str:
+        """
+        A text file cut to a character prefix that can never fit less than the context window
+        (the exact token cut happens in _build_prompt), so huge files are not read whole.
+        """
+        return read_truncated(path, self.context_window * 2 * CHARS_PER_TOKEN)
+
+    async def _read_sections(self, txt_files: list) -> list:
+        """(file name, text) for each file, read in worker threads."""
+        texts = await asyncio.gather(*(asyncio.to_thread(self._read_paper, f) for f in txt_files))
+        return [(f.name, text) for f, text in zip(txt_files, texts)]
+
+    async def _summarize_group(self, files: list) -> list:
+        """Summaries for several files from one request; files missing from the reply are retried alone."""
+        # Each group reads its own files, so reading overlaps the other groups' requests
+        group = await self._read_sections(files)
+        if len(group) == 1:
+            return [await self._summarize(group)]
+
+        # Files summarized before (alone or in another pack) are not sent again
+        found = {}
+        for name, text in group:
+            cached = self._cached_summary(name, text)
+            if cached is not None:
+                found[name] = cached
+        pending = [section for section in group if section[0] not in found]
+        if len(pending) > 1:
+            await self._summarize_packed(pending, found)
+        missing = [section for section in pending if section[0] not in found]
+        singles = await asyncio.gather(*(self._summarize([section]) for section in missing))
+        found.update((name, part) for (name, _), part in zip(missing, singles))
+        return [found[name] for name, _ in group]
+
+    async def _summarize_packed(self, group: list, found: dict):
+        """One request for several files; each summary in the reply is added to found and cached."""
+        logger.info(f"Summarizing {', '.join(name for name, _ in group)} in one request")
+        texts = dict(group)
+        try:
+            prompt, _ = await asyncio.to_thread(self._build_prompt, group, True)
+            raw = await self.call_llm(prompt)
+            data = self.try_parse(raw) or self.try_parse(self._repair(raw)) or {}
+            for entry in data.get("Summaries", []):
+                if isinstance(entry, dict) and isinstance(entry.get("SummaryDoc"), str):
+                    name = str(entry.get("file", ""))
+                    if name in texts:
+                        found[name] = entry["SummaryDoc"].strip()
+                        self._store_summary(name, texts[name], found[name])
+        except Exception as e:
+            logger.warning(f"⚠️ Packed request failed ({e}); falling back to one request per file.")
+
+    # ------------------------------------------------------------------
+    # Batch API (offline runs: half the price, results within 24h)
+    # ------------------------------------------------------------------
+    def _submit_batch(self, client, jobs: list) -> str:
+        """Upload (custom_id, prompt) jobs as a JSONL batch input and start the batch; returns its id."""
+        cache_key = self._prompt_cache_key()
+        with tempfile.NamedTemporaryFile("wb", suffix=".jsonl", delete=False) as f:
+            for custom_id, prompt in jobs:
+                f.write(json_dumps({
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": self.model,
+                        "messages": [
+                            {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+                            {"role": "user", "content": prompt},
+                        ],
+                        "max_completion_tokens": self.max_tokens,
+                        "response_format": {"type": "json_object"},
+                        "prompt_cache_key": cache_key,
+                        **self._sampling(),
+                    },
+                }) + b"\n")
+        try:
+            with open(f.name, "rb") as fh:
+                uploaded = client.files.create(file=fh, purpose="batch")
+        finally:
+            os.remove(f.name)
+        batch = client.batches.create(
+            input_file_id=uploaded.id, endpoint="/v1/chat/completions", completion_window="24h"
+        )
+        logger.info(f"📦 Submitted batch {batch.id} with {len(jobs)} request(s)")
+        return batch.id
+
+    def _wait_batch(self, client, batch_id: str, poll: float = 30.0) -> dict:
+        """Poll a batch until it finishes; returns {custom_id: reply content} for the successful requests."""
+        while True:
+            batch = client.batches.retrieve(batch_id)
+            if batch.status in ("completed", "failed", "expired", "cancelled"):
+                break
+            time.sleep(poll)
+        logger.info(f"📦 Batch {batch_id} finished: {batch.status}")
+        if not batch.output_file_id:
+            raise RuntimeError(f"Batch {batch_id} ended as {batch.status} without output")
+
+        results = {}
+        for line in client.files.content(batch.output_file_id).content.splitlines():
+            if not line.strip():
+                continue
+            item = json_loads(line)
+            response = item.get("response") or {}
+            if response.get("status_code") == 200:
+                results[item["custom_id"]] = (response["body"]["choices"][0]["message"]["content"] or "").strip()
+            else:
+                logger.warning(f"⚠️ Batch request {item.get('custom_id')} failed: {item.get('error') or response}")
+        return results
+
+    def _summarize_batch(self, txt_files: list) -> str:
+        """
+        Summarize the text files through the Batch API (cached replies are not resubmitted): one
+        combined request as in the direct path, or one per file when section_workers > 1.
+        """
+        from openai import OpenAI
+
+        client = OpenAI(http_client=shared_openai_http_client())
+        units = [[f] for f in txt_files] if self.section_workers > 1 else [txt_files]
+        parts, jobs = {}, []
+        # Files are read and their prompts built in parallel; only the cache lookups run in order
+        with ThreadPoolExecutor(max_workers=min(8, len(units))) as ex:
+            prompts = list(ex.map(
+                lambda unit: self._build_prompt([(f.name, self._read_paper(f)) for f in unit])[0], units
+            ))
+        for unit, prompt in zip(units, prompts):
+            key = LLMResponseCache.key(self.model, self.max_tokens, self.temperature, SUMMARY_SYSTEM_PROMPT, prompt)
+            cached = self.cache.get(key)
+            if cached is not None:
+                parts[unit[0].name] = cached
+            else:
+                jobs.append((unit[0].name, prompt, key)) # The first file name identifies the request
+
+        if jobs:
+            outputs = self._wait_batch(client, self._submit_batch(client, [(name, prompt) for name, prompt, _ in jobs]))
+            for name, _, key in jobs:
+                if name not in outputs:
+                    raise RuntimeError(f"No batch result for {name}")
+                self.cache.put(key, outputs[name])
+                parts[name] = outputs[name]
+        return "\n\n".join(filter(None, (self._parse_summary(parts[unit[0].name]) for unit in units)))
+
+    async def _summarize_all(self, txt_files: list) -> str:
+        """Read the text files and summarize them: one request per file when there are several."""
+        from openai import AsyncOpenAI # Imported on first use; the SDK is slow to load
+
+        self._llm_sem = asyncio.Semaphore(max(1, self.section_workers))
+        # Retries are handled in call_llm, so the SDK's own retries are disabled
+        self.client = AsyncOpenAI(http_client=openai_http_client(async_client=True), max_retries=0)
+        try:
+            if len(txt_files) > 1 and self.section_workers > 1:
+                # Latency is the slowest request rather than the sum; the parts are joined in file order
+                logger.info(f"Summarizing {len(txt_files)} files in parallel")
+                size = max(1, self.batch_size)
+                groups = [txt_files[i:i + size] for i in range(0, len(txt_files), size)]
+                parts = await asyncio.gather(*(self._summarize_group(group) for group in groups))
+                return "\n\n".join(part for group in parts for part in group if part)
+            sections = await self._read_sections(txt_files)
+            if self.stream_docx:
+                return await self._summarize_streaming(sections)
+            return await self._summarize(sections)
+        finally:
+            await self.client.close()
+            self.client = None
+
     def run(self, pdf_stem: str):
         """Main process to generate summary document."""
         try:
-            print(f"\nProcessing {pdf_stem}")
+            logger.info(f"\nProcessing {pdf_stem}")
             
             # Load and process text
             txt_files = sorted(self.txt_dir.glob("*.txt"))
             if not txt_files:
                 raise FileNotFoundError(f"No .txt files in {self.txt_dir}")
                 
-            combined = "\n\n".join(
-                f"--- FILE: {f.name} ---\n{f.read_text(encoding='utf-8')}"
-                for f in txt_files
-            )
-            
-            # Call LLM with retry on JSON error
-            prompt = self.load_prompt().replace("<<<DOCUMENT_TEXT>>>", combined)
-            raw = self.call_llm(prompt)
-            
-            if not raw:
-                raise ValueError("Empty response from LLM")
-                
-            # Parse response with fallback cleaning
-            try:
-                parsed = json.loads(raw)
-            except json.JSONDecodeError:
-                cleaned = self.clean_raw(raw)
-                try:
-                    parsed = json.loads(cleaned)
-                except json.JSONDecodeError as e:
-                    print(f"Failed to parse JSON even after cleaning: {e}")
-                    # Create minimal valid response
-                    parsed = {"SummaryDoc": raw}
-            
-            summary = parsed.get("SummaryDoc", "").strip()
+            self._streamed_doc = None
+            if self.use_batch:
+                summary = self._summarize_batch(txt_files)
+            else:
+                summary = asyncio.run(self._summarize_all(txt_files))
+
             if not summary:
                 raise ValueError("Empty summary document")
                 
             # Create final DOCX
-            self.create_docx(summary)
+            if self._streamed_doc is not None:
+                self.save_docx(self._streamed_doc)
+            else:
+                self.create_docx(summary)
             return True
             
         except Exception as e:
-            print(f"ERROR in summarize: {e}")
+            logger.error(f"ERROR in summarize: {e}")
             return False
 
 # ...existing code...
@@ -317,17 +925,17 @@ def run(pdf_path, out_dir, prev=None):
         output_docx = out / f"{pdf_stem}_Summary.docx"
         
         # Debug print paths
-        print(f"\nInput paths for {pdf_stem}:")
-        print(f"- Text dir: {txt_dir}")
-        print(f"- Images dir: {images_dir}")
-        print(f"- Output DOCX: {output_docx}")
+        logger.info(f"\nInput paths for {pdf_stem}:")
+        logger.info(f"- Text dir: {txt_dir}")
+        logger.info(f"- Images dir: {images_dir}")
+        logger.info(f"- Output DOCX: {output_docx}")
         
         # Verify inputs exist
         if not txt_dir.exists() or not any(txt_dir.glob("*.txt")):
             raise FileNotFoundError(f"No text files found in: {txt_dir}")
             
         if not images_dir.exists():
-            print(f"Warning: Images directory not found: {images_dir}")
+            logger.warning(f"Warning: Images directory not found: {images_dir}")
         
         # Initialize and run summarizer
         summarizer = PaperSummarizer(
@@ -337,7 +945,9 @@ def run(pdf_path, out_dir, prev=None):
             output_path=output_docx,
             model="gpt-4-turbo",
             max_tokens=4096,
-            max_retries=3
+            max_retries=3,
+            temperature=0.0,
+            use_batch=batch_api_enabled(),
         )
         
         if summarizer.run(pdf_stem):
@@ -353,8 +963,11 @@ def run(pdf_path, out_dir, prev=None):
             }
             
     except Exception as e:
-        print(f"ERROR in 08_summarize: {e}")
+        logger.error(f"ERROR in 08_summarize: {e}")
         return {"status": "error", "error": str(e)}
+    finally:
+        # This was the last reader of the PDF's images; what it did not use must not outlive the run
+        forget_files(Path(out_dir).parent)
 
 # ----------------------------------------------------------------------
 # Optional: CLI entry point (if you want to run this file directly)
@@ -363,7 +976,7 @@ if __name__ == "__main__":
     # This is just for testing this script directly
     # You would need to manually set up the paths
     
-    print("Running PaperSummarizer in standalone mode...")
+    logger.info("Running PaperSummarizer in standalone mode...")
     
     # --- Example paths for direct testing ---
     # You MUST change these to match your test setup
@@ -389,15 +1002,14 @@ if __name__ == "__main__":
             prompt_path=MOCK_PROMPT,
             output_path=MOCK_OUT_FILE,
             model="gpt-4-turbo",
-            max_tokens=4096
+            max_tokens=4096,
+            temperature=0.0,
         )
         
         summarizer.run(pdf_stem=PDF_STEM)
         
     except Exception as e:
-        print(f"Error during standalone test: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"Error during standalone test: {e}")
 # ----------------------------------------------------------------------
 # ---------------------------------------------------------------------
 #=============================================================
@@ -1,4 +1,5 @@
 import sys
+import atexit
 import datetime
 from pathlib import Path
 import pandas as pd
@@ -17,7 +18,7 @@ class Tee:
     def write(self, obj):
         for f in self.files:
             try: # Add basic error handling for logging
-                f.write(obj); f.flush()
+                f.write(obj) # Log file is line-buffered; no flush per write
             except Exception as e:
                 print(f"Error writing to log {getattr(f, 'name', 'unknown')}: {e}", file=sys.__stderr__)
     def flush(self):
@@ -53,7 +54,9 @@ class ComparisonMerger:
         if self._logger_initialized:
             return
         try:
-            log_f = open(self.log_file, "w", encoding="utf-8")
+            log_f = open(self.log_file, "w", encoding="utf-8", buffering=1)
+            # Line buffering writes whole lines; a last line without a newline is written at exit
+            atexit.register(log_f.flush)
             # Only replace if not already Tee, otherwise add file
             if not isinstance(sys.stdout, Tee):
                 print("(Merge Step) Initializing Tee logger.")
@@ -1,32 +1,177 @@
 import os
 import fitz
+import hashlib
+import multiprocessing
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from utils import IMAGE_ALIASES_FILE, json_dumps_pretty, remember_file
 
-def extract_images_from_pdf(pdf_path: str, output_folder: str) -> None:
-    """Extract all images from a PDF file."""
-    doc = fitz.open(pdf_path)
-    
-    for page_num, page in enumerate(doc, start=1):
-        image_list = page.get_images()
-        
-        for img_idx, img in enumerate(image_list, start=1):
-            xref = img[0]
-            base_image = doc.extract_image(xref)
-            
-            try:
-                image_bytes = base_image["image"]
-                image_ext = base_image["ext"]
-                
-                # Use JPEG instead of PNG for problematic images
-                if image_ext.lower() == "png":
-                    image_ext = "jpg"
-                
-                image_filename = f"page{page_num}_img{img_idx}.{image_ext}"
-                with open(os.path.join(output_folder, image_filename), "wb") as img_file:
-                    img_file.write(image_bytes)
-                    
-            except ValueError as e:
-                print(f"Warning: Could not save image {img_idx} from page {page_num}: {e}")
-                continue
-                
-    doc.close()
\ No newline at end of file
+# Below this many pages per worker, process start-up costs more than it saves
+MIN_PAGES_PER_WORKER = 16
+# Embedded formats written as-is; anything else (JPX, JBIG2, ...) can't be placed in a DOCX
+NATIVE_EXTS = frozenset({"png", "jpg", "jpeg", "bmp", "tif", "tiff"})
+
+
+def _write_bytes(path: str, data: bytes) -> None:
+    with open(path, "wb") as img_file:
+        img_file.write(data)
+    # In the pipeline process, the summary step picks these bytes up instead of re-reading the file
+    if multiprocessing.parent_process() is None:
+        remember_file(path, data)
+
+
+def _prefetch(path: str) -> None:
+    """Ask the kernel to start reading the whole file into the page cache (no-op where unsupported)."""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            # WILLNEED rather than SEQUENTIAL: readahead hints apply to the advising fd only,
+            # while MuPDF reads through its own handle; the page cache is shared
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+def _masked_png(doc, xref: int, smask: int) -> bytes:
+    """Composite an image with its soft mask and encode it as PNG with MuPDF's own encoder."""
+    pix = fitz.Pixmap(fitz.Pixmap(doc, xref), fitz.Pixmap(doc, smask))
+    if pix.colorspace and pix.colorspace.n > 3: # PNG has no CMYK
+        pix = fitz.Pixmap(fitz.csRGB, pix)
+    return pix.tobytes("png")
+
+
+def _rgb_png(doc, xref: int) -> bytes:
+    """Decode an image and encode it as RGB (or grayscale) PNG with MuPDF's own encoder."""
+    pix = fitz.Pixmap(doc, xref)
+    if pix.colorspace and pix.colorspace.n > 3: # PNG has no CMYK
+        pix = fitz.Pixmap(fitz.csRGB, pix)
+    return pix.tobytes("png")
+
+
+def _extract_page_range(pdf_path: str, output_folder: str, start: int = 0, stop: int = None, write_workers: int = 4,
+                        dedupe: bool = True) -> dict:
+    """
+    Extract the images of pages [start, stop) using this process's own document handle.
+    Returns {skipped file name: first file name} for images that were already written.
+    """
+    seen_xrefs = {} # xref -> first file name (same image object placed on several pages)
+    seen_digests = {} # content digest -> first file name (identical bytes stored twice)
+    duplicates = {}
+    with fitz.open(pdf_path) as doc, ThreadPoolExecutor(max_workers=write_workers) as writer:
+        pending = []
+        stop = doc.page_count if stop is None else min(stop, doc.page_count)
+        for page_index in range(start, stop):
+            page_num = page_index + 1
+            image_list = doc.load_page(page_index).get_images()
+
+            for img_idx, img in enumerate(image_list, start=1):
+                xref, smask = img[0], img[1]
+
+                # Repeated logos/headers: the first copy is the only one written
+                if dedupe and xref in seen_xrefs:
+                    first = seen_xrefs[xref]
+                    duplicates[f"page{page_num}_img{img_idx}{os.path.splitext(first)[1]}"] = first
+                    continue
+
+                # Images with a soft mask need their alpha composited, or transparency is lost
+                if smask:
+                    try:
+                        image_filename = f"page{page_num}_img{img_idx}.png"
+                        data = _masked_png(doc, xref, smask)
+                        # Recorded only once the composite exists; a failed one falls through to the raw stream
+                        seen_xrefs[xref] = image_filename
+                        pending.append(writer.submit(_write_bytes, os.path.join(output_folder, image_filename), data))
+                        continue
+                    except (RuntimeError, ValueError) as e:
+                        print(f"Warning: Could not apply mask to image {img_idx} on page {page_num}, saving it as is: {e}")
+
+                # Otherwise the embedded stream is written as-is, without decoding or re-encoding
+                base_image = doc.extract_image(xref)
+
+                try:
+                    image_bytes = base_image["image"]
+                    image_ext = base_image["ext"]
+
+                    # Only CMYK and formats Word can't show are decoded and re-encoded
+                    reencoded = False
+                    if image_ext.lower() not in NATIVE_EXTS or base_image.get("colorspace", 0) > 3:
+                        try:
+                            image_bytes, image_ext = _rgb_png(doc, xref), "png"
+                            reencoded = True # Real PNG bytes, named .png like the masked images
+                        except (RuntimeError, ValueError) as e:
+                            print(f"Warning: Could not convert image {img_idx} on page {page_num}, saving it as is: {e}")
+
+                    # Use JPEG instead of PNG for problematic images
+                    if image_ext.lower() == "png" and not reencoded:
+                        image_ext = "jpg"
+
+                    image_filename = f"page{page_num}_img{img_idx}.{image_ext}"
+                    if dedupe:
+                        digest = hashlib.blake2b(image_bytes, digest_size=16).digest()
+                        first = seen_digests.setdefault(digest, image_filename)
+                        seen_xrefs[xref] = first
+                        if first != image_filename:
+                            duplicates[image_filename] = first
+                            continue
+                    pending.append(writer.submit(
+                        _write_bytes, os.path.join(output_folder, image_filename), image_bytes
+                    ))
+
+                except ValueError as e:
+                    print(f"Warning: Could not save image {img_idx} from page {page_num}: {e}")
+                    continue
+
+        # Surface write errors the same way the inline writes did
+        for fut in pending:
+            fut.result()
+    return duplicates
+
+
+def _save_aliases(output_folder: str, duplicates: dict) -> dict:
+    """Write the skipped -> written name map next to the images (removing a stale one when there is none)."""
+    path = os.path.join(output_folder, IMAGE_ALIASES_FILE)
+    if duplicates:
+        with open(path, "wb") as f:
+            f.write(json_dumps_pretty(duplicates))
+    elif os.path.exists(path):
+        os.remove(path)
+    return duplicates
+
+
+def extract_images_from_pdf(pdf_path: str, output_folder: str, write_workers: int = 4, page_workers: int = 1,
+                            dedupe: bool = True) -> dict:
+    """Extract all images from a PDF file.
+
+    PyMuPDF documents must not be shared across threads, so pages are read
+    in order and only the file writes go to a small thread pool. With
+    page_workers > 1 (opt-in), a long PDF is split into page ranges handled
+    by separate processes, each opening its own document.
+
+    With dedupe, an image that repeats (same object or same bytes) is written
+    once; the return value maps each skipped file name to the file that was
+    written. Page-range workers dedupe within their own range only. The map
+    is also saved as IMAGE_ALIASES_FILE in output_folder, so figure markers
+    naming a skipped image still resolve to the written copy.
+    """
+    _prefetch(pdf_path)
+    if page_workers > 1:
+        with fitz.open(pdf_path) as doc:
+            page_count = doc.page_count
+        workers = min(page_workers, page_count // MIN_PAGES_PER_WORKER)
+        if workers > 1:
+            step = -(-page_count // workers)
+            duplicates = {}
+            # Spawned, not forked: callers (main.py's stage threads) are multithreaded, and a fork
+            # could inherit a lock another thread holds (logging, httpx) and deadlock
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as ex:
+                futures = [ex.submit(_extract_page_range, pdf_path, output_folder, start, start + step, write_workers, dedupe)
+                           for start in range(0, page_count, step)]
+                for fut in futures:
+                    duplicates.update(fut.result())
+            return _save_aliases(output_folder, duplicates)
+
+    return _save_aliases(output_folder, _extract_page_range(pdf_path, output_folder, write_workers=write_workers, dedupe=dedupe))
@@ -1,15 +1,55 @@
 import fitz
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor
 
-def render_pdf_pages(pdf_path, output_folder, zoom=4):
-    os.makedirs(output_folder, exist_ok=True)
-    pdf = fitz.open(pdf_path)
+# Rendering at zoom=4 costs far more per page than extraction, so fewer pages justify a worker
+MIN_PAGES_PER_WORKER = 4
+# Lossy quality for jpg/webp pages; PNG stays the default since text pages compress better losslessly
+JPEG_QUALITY = 90
+PAGE_FORMATS = ("png", "jpg", "webp")
+
+
+def _page_bytes(pix, fmt):
+    if fmt == "jpg":
+        return pix.tobytes("jpg", jpg_quality=JPEG_QUALITY)
+    if fmt == "webp": # MuPDF has no WebP writer; goes through Pillow
+        return pix.pil_tobytes(format="WEBP", quality=JPEG_QUALITY)
+    return pix.tobytes("png")
+
+
+def _render_page_range(pdf_path, output_folder, zoom, start=0, stop=None, fmt="png"):
+    """Render pages [start, stop) using this process's own document handle."""
     pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
+    matrix = fitz.Matrix(zoom, zoom)
+    with fitz.open(pdf_path) as pdf:
+        stop = pdf.page_count if stop is None else min(stop, pdf.page_count)
+        for page_index in range(start, stop):
+            page = pdf.load_page(page_index)
+            pix = page.get_pixmap(matrix=matrix)  # high-res render
+            image_filename = f"{pdf_name}_page{page_index + 1}.{fmt}"
+            with open(os.path.join(output_folder, image_filename), "wb") as f:
+                f.write(_page_bytes(pix, fmt))
+            print(f"✅ Rendered {image_filename}")
+
+
+def render_pdf_pages(pdf_path, output_folder, zoom=4, page_workers=1, fmt="png"):
+    """Render every page as fmt (png, jpg or webp). Page ranges go to separate processes (PyMuPDF documents are not shareable)."""
+    if fmt not in PAGE_FORMATS:
+        raise ValueError(f"Unsupported page format {fmt!r}; expected one of {PAGE_FORMATS}")
+    os.makedirs(output_folder, exist_ok=True)
+    with fitz.open(pdf_path) as pdf:
+        page_count = pdf.page_count
+
+    workers = min(page_workers, page_count // MIN_PAGES_PER_WORKER)
+    if workers <= 1:
+        _render_page_range(pdf_path, output_folder, zoom, fmt=fmt)
+        return
 
-    for page_index in range(len(pdf)):
-        page = pdf.load_page(page_index)
-        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))  # high-res render
-        image_filename = f"{pdf_name}_page{page_index + 1}.png"
-        pix.save(os.path.join(output_folder, image_filename))
-        print(f"✅ Rendered {image_filename}")
-    pdf.close()
+    step = -(-page_count // workers)
+    # Spawned, not forked, as in extract_images: callers may be multithreaded
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as ex:
+        futures = [ex.submit(_render_page_range, pdf_path, output_folder, zoom, start, start + step, fmt)
+                   for start in range(0, page_count, step)]
+        for fut in futures:
+            fut.result()
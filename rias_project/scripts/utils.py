@@ -0,0 +1,744 @@
+"""Shared helpers for the pipeline scripts in this folder."""
+import asyncio
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import random
+import re
+import sys
+import threading
+import time
+from contextlib import closing
+from functools import lru_cache
+from pathlib import Path
+
+# ----------------------------------------------------------------------
+# Logging (console + per-run log file, replacing the old stdout Tee)
+# ----------------------------------------------------------------------
+_logger_lock = threading.Lock()
+LOG_MAX_BYTES = 10 << 20 # A runaway run rolls over to .1/.2/.3 instead of growing one file without bound
+LOG_BACKUPS = 3
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Return a named logger that prints plain messages to the real stdout (handler added once)."""
+    logger = logging.getLogger(name)
+    with _logger_lock:
+        if not logger.handlers:
+            handler = logging.StreamHandler(sys.__stdout__)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+    return logger
+
+
+def attach_log_file(logger: logging.Logger, log_file) -> logging.FileHandler:
+    """Also write the logger's output to log_file (size-rotated), closing any file handler attached earlier."""
+    handler = logging.handlers.RotatingFileHandler(
+        log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding="utf-8"
+    )
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    with _logger_lock:
+        for old in [h for h in logger.handlers if isinstance(h, logging.FileHandler)]:
+            logger.removeHandler(old)
+            old.close()
+        logger.addHandler(handler)
+    return handler
+
+
+# ----------------------------------------------------------------------
+# JSON (orjson when installed, stdlib otherwise)
+# ----------------------------------------------------------------------
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_loads(data):
+    """Parse JSON from str or bytes. Errors are json.JSONDecodeError either way."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj) -> bytes:
+    """Serialize obj as compact UTF-8 JSON bytes (e.g. one JSONL line), keeping non-ASCII text as-is."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def json_dumps_pretty(obj) -> bytes:
+    """Serialize obj as 2-space indented UTF-8 JSON bytes, keeping non-ASCII text as-is."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+
+
+# ----------------------------------------------------------------------
+# Directory listing
+# ----------------------------------------------------------------------
+def list_files(directory, suffix: str) -> list:
+    """Return the non-hidden files in directory whose name ends with suffix, sorted by name."""
+    with os.scandir(directory) as it:
+        return sorted(
+            (Path(e.path) for e in it
+             if e.name[0] != "." and e.name.endswith(suffix) and e.is_file()),
+            key=lambda p: p.name,
+        )
+
+
+# ----------------------------------------------------------------------
+# In-process file handoff (extracted images -> summary DOCX)
+# ----------------------------------------------------------------------
+# Written next to the extracted images: {skipped duplicate name: name of the file that was written}
+IMAGE_ALIASES_FILE = "image_aliases.json"
+HANDOFF_MAX_BYTES = 64 << 20 # Oldest entries are dropped past this; readers then fall back to disk
+_handoff = {} # (path, mtime_ns, size) -> bytes, in insertion order
+_handoff_bytes = 0
+_handoff_lock = threading.Lock()
+
+
+def _handoff_key(path, st) -> tuple:
+    return os.path.abspath(path), st.st_mtime_ns, st.st_size
+
+
+def remember_file(path, data: bytes) -> None:
+    """Keep the bytes just written to path for a later step in this process (see read_file_bytes)."""
+    global _handoff_bytes
+    if len(data) > HANDOFF_MAX_BYTES:
+        return
+    key = _handoff_key(path, os.stat(path))
+    with _handoff_lock:
+        if key not in _handoff:
+            _handoff[key] = data
+            _handoff_bytes += len(data)
+        while _handoff_bytes > HANDOFF_MAX_BYTES:
+            _handoff_bytes -= len(_handoff.pop(next(iter(_handoff))))
+
+
+def read_file_bytes(path) -> bytes:
+    """
+    The file's bytes, taken from remember_file if it handed over this exact version
+    (same mtime and size); otherwise read from disk. A handed-over entry is used once.
+    """
+    global _handoff_bytes
+    key = _handoff_key(path, os.stat(path))
+    with _handoff_lock:
+        data = _handoff.pop(key, None)
+        if data is not None:
+            _handoff_bytes -= len(data)
+            return data
+    return Path(path).read_bytes()
+
+
+def forget_files(folder) -> None:
+    """Drop handed-over bytes for files under folder that were never read (e.g. images no figure used)."""
+    global _handoff_bytes
+    prefix = os.path.join(os.path.abspath(folder), "")
+    with _handoff_lock:
+        for key in [k for k in _handoff if k[0].startswith(prefix)]:
+            _handoff_bytes -= len(_handoff.pop(key))
+
+
+# ----------------------------------------------------------------------
+# LLM output cleanup
+# ----------------------------------------------------------------------
+# Opening ```json fence and the payload up to the first closing fence (anything after it is dropped);
+# the closing fence may be missing on truncated replies
+_FENCE_RE = re.compile(r"^\s*```(?:json)?(.*?)(?:```|$)", re.DOTALL | re.IGNORECASE)
+
+
+def strip_json_fence(raw: str) -> str:
+    """Return the JSON text of an LLM reply, without markdown code fences or a bare "json" label."""
+    if not raw:
+        return ""
+    m = _FENCE_RE.match(raw)
+    raw = (m.group(1) if m else raw).strip()
+    if raw[:4].lower() == "json":
+        raw = raw[4:].strip()
+    return raw
+
+
+class JsonArrayStream:
+    """
+    Incremental scanner for a JSON object reply that arrives in pieces: on_item(key, item)
+    is called for each object element of the top-level arrays named in `keys` as soon as
+    that element is complete. Only the element being read is buffered.
+    """
+
+    def __init__(self, keys, on_item):
+        self.keys = frozenset(keys)
+        self.on_item = on_item
+        self.reset()
+
+    def reset(self):
+        self._depth = 0
+        self._in_str = self._escaped = False
+        self._str = []        # Characters of the current top-level string (a key candidate)
+        self._last_str = None
+        self._key = None      # Name of the array being read, if it is one of `keys`
+        self._item = None     # Characters of the element being read
+
+    def feed(self, delta: str) -> None:
+        for ch in delta:
+            if self._item is not None:
+                self._item.append(ch)
+            if self._in_str:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_str = False
+                    if self._depth == 1:
+                        self._last_str = "".join(self._str)
+                elif self._depth == 1:
+                    self._str.append(ch)
+            elif ch == '"':
+                self._in_str = True
+                self._str = []
+            elif ch == "{" or ch == "[":
+                if self._depth == 1 and ch == "[":
+                    self._key = self._last_str if self._last_str in self.keys else None
+                elif self._depth == 2 and ch == "{" and self._key is not None:
+                    self._item = ["{"]
+                self._depth += 1
+            elif ch == "}" or ch == "]":
+                self._depth -= 1
+                if self._depth == 2 and self._item is not None:
+                    text, self._item = "".join(self._item), None
+                    try:
+                        item = json_loads(text)
+                    except ValueError:
+                        continue
+                    self.on_item(self._key, item)
+                elif self._depth == 1:
+                    self._key = None
+
+
+# ----------------------------------------------------------------------
+# Prompt templates
+# ----------------------------------------------------------------------
+DOCUMENT_MARKER = "<<<DOCUMENT_TEXT>>>"
+
+
+TRUNCATION_NOTE = "\n\n[Text truncated for LLM]"
+
+
+def read_truncated(path, limit: int) -> str:
+    """Read at most `limit` characters of a text file (plus a note if it was longer)."""
+    with open(path, "r", encoding="utf-8") as f:
+        data = f.read(limit + 1) # One extra character tells us whether anything was cut
+    return data if len(data) <= limit else data[:limit] + TRUNCATION_NOTE
+
+
+# Token counting uses tiktoken when installed; otherwise ~4 characters per token is assumed
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=4)
+def _encoding(model: str):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def count_tokens(text: str, model: str = "gpt-4o") -> int:
+    if tiktoken is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(_encoding(model).encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text: str, max_tokens: int, model: str = "gpt-4o") -> str:
+    """Cut text to at most `max_tokens` tokens (plus a note if it was longer)."""
+    if tiktoken is None:
+        limit = max_tokens * CHARS_PER_TOKEN
+        return text if len(text) <= limit else text[:limit] + TRUNCATION_NOTE
+    enc = _encoding(model)
+    tokens = enc.encode(text, disallowed_special=())
+    return text if len(tokens) <= max_tokens else enc.decode(tokens[:max_tokens]) + TRUNCATION_NOTE
+
+
+def read_truncated_tokens(path, max_tokens: int, model: str = "gpt-4o") -> str:
+    """Read a text file cut to at most `max_tokens` tokens (plus a note if it was longer)."""
+    if tiktoken is None:
+        return read_truncated(path, max_tokens * CHARS_PER_TOKEN)
+    # Read a generous character prefix only; prose averages ~4 characters per token
+    limit = max_tokens * 2 * CHARS_PER_TOKEN
+    with open(path, "r", encoding="utf-8") as f:
+        data = f.read(limit + 1)
+    enc = _encoding(model)
+    tokens = enc.encode(data, disallowed_special=())
+    if len(tokens) > max_tokens:
+        return enc.decode(tokens[:max_tokens]) + TRUNCATION_NOTE
+    return data if len(data) <= limit else data[:limit] + TRUNCATION_NOTE
+
+
+@lru_cache(maxsize=16)
+def _read_prompt_cached(path: str, mtime_ns: int) -> str:
+    return Path(path).read_text(encoding="utf-8")
+
+
+def read_prompt(path) -> str:
+    """Read a prompt file once per process; an edited file (new mtime) is re-read."""
+    path = Path(path)
+    return _read_prompt_cached(str(path), path.stat().st_mtime_ns)
+
+
+@lru_cache(maxsize=16)
+def split_prompt(template: str) -> tuple:
+    """
+    Split a prompt template into (prefix, suffix) around the document marker.
+    Memoized: read_prompt hands back the same cached string, so repeat calls are a dict hit.
+
+    Keep the marker at the end of the template: OpenAI caches repeated prompt
+    prefixes automatically, so the static instructions should come first and
+    be byte-identical across papers, with the paper text appended last.
+    """
+    prefix, marker, suffix = template.partition(DOCUMENT_MARKER)
+    if not marker:
+        raise ValueError(f"Prompt template is missing the {DOCUMENT_MARKER} marker.")
+    return prefix, suffix
+
+
+# ----------------------------------------------------------------------
+# Excel templates (write-only workbooks rebuilt from a template layout)
+# ----------------------------------------------------------------------
+def read_template_layout(template_path) -> list:
+    """Read sheet names, rows, column widths and freeze panes from an Excel template."""
+    from openpyxl import load_workbook
+
+    wb = load_workbook(template_path)
+    layout = []
+    for ws in wb.worksheets:
+        layout.append({
+            "title": ws.title,
+            "rows": [row for row in ws.iter_rows(values_only=True)],
+            # A dimension may cover a range of columns (min..max); keep the range, not just its first letter
+            "widths": {col: (dim.min, dim.max, dim.width) for col, dim in ws.column_dimensions.items() if dim.width},
+            "freeze_panes": ws.freeze_panes,
+        })
+    wb.close()
+    return layout
+
+
+def new_write_only_workbook():
+    """Create a write-only workbook with a single bold 'header' named style."""
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, NamedStyle
+
+    wb = Workbook(write_only=True)
+    wb.add_named_style(NamedStyle(name="header", font=Font(bold=True)))
+    return wb
+
+
+def add_layout_sheet(wb, sheet: dict):
+    """
+    Create a write-only sheet mirroring one template sheet (widths, freeze
+    panes, bold header row) and return it together with its header list.
+    """
+    from openpyxl.cell import WriteOnlyCell
+
+    ws = wb.create_sheet(sheet["title"])
+    for col, (lo, hi, width) in sheet["widths"].items():
+        dim = ws.column_dimensions[col]
+        dim.width = width
+        if lo and hi:
+            dim.min, dim.max = lo, hi
+    ws.freeze_panes = sheet["freeze_panes"]
+
+    headers = list(sheet["rows"][0]) if sheet["rows"] else []
+    header_cells = []
+    for h in headers:
+        cell = WriteOnlyCell(ws, value=h)
+        cell.style = "header"
+        header_cells.append(cell)
+    ws.append(header_cells)
+    return ws, headers
+
+
+# ----------------------------------------------------------------------
+# OpenAI HTTP client (pooled keep-alive connections, HTTP/2 when available)
+# ----------------------------------------------------------------------
+def openai_http_client(async_client: bool = False):
+    """
+    httpx client to pass as OpenAI(http_client=...). Connections are reused across
+    requests; HTTP/2 multiplexing is enabled when the optional 'h2' package is installed.
+    """
+    import httpx
+
+    try:
+        import h2  # noqa: F401
+        http2 = True
+    except ImportError:
+        http2 = False
+    kwargs = dict(
+        http2=http2,
+        # Long read timeout: large completions are returned in one response. A short pool timeout
+        # surfaces a saturated pool as an error (and a retry) instead of an open-ended wait
+        timeout=httpx.Timeout(connect=10.0, read=600.0, write=60.0, pool=10.0),
+        # Idle connections stay open for a minute, so bursts of fan-out requests skip the TLS handshake
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60.0),
+    )
+    # Every response's rate-limit headers feed the process-wide gate the call_llm loops wait on
+    gate = rate_limit_gate()
+    if async_client:
+        async def observe(response):
+            gate.observe(response.headers)
+    else:
+        def observe(response):
+            gate.observe(response.headers)
+    kwargs["event_hooks"] = {"response": [observe]}
+    return httpx.AsyncClient(**kwargs) if async_client else httpx.Client(**kwargs)
+
+
+def raw_http_enabled() -> bool:
+    """Opt-in (RIAS_RAW_HTTP=1): async chat calls POST to the REST endpoint instead of going through the SDK."""
+    return os.getenv("RIAS_RAW_HTTP") == "1"
+
+
+async def raw_chat_completion(http, **payload) -> str:
+    """
+    Create a chat completion with a plain POST on `http` (an openai_http_client(async_client=True))
+    and return the message content, skipping the SDK's request objects and response models.
+    HTTP errors raise httpx.HTTPStatusError, whose response headers retry_delay understands.
+    """
+    base_url = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
+    resp = await http.post(
+        f"{base_url}/chat/completions",
+        content=json_dumps(payload),
+        headers={"Authorization": f"Bearer {os.environ['OPENAI_API_KEY']}", "Content-Type": "application/json"},
+    )
+    resp.raise_for_status()
+    return json_loads(resp.content)["choices"][0]["message"]["content"] or ""
+
+
+@lru_cache(maxsize=1)
+def shared_openai_http_client():
+    """
+    One pooled sync client per process, so the per-paper step instances created by
+    main.py keep their TLS connections across papers. Never close it.
+    """
+    return openai_http_client()
+
+
+def batch_api_enabled() -> bool:
+    """Set by `main.py --batch`: steps that support it send their requests as Batch API jobs."""
+    return os.getenv("RIAS_USE_BATCH_API") == "1"
+
+
+def log_prompt_cache(logger: logging.Logger, usage) -> None:
+    """Log how many input tokens OpenAI served from its prompt-prefix cache (usage from a chat completion)."""
+    details = getattr(usage, "prompt_tokens_details", None)
+    if details is None or not usage.prompt_tokens:
+        return
+    cached = getattr(details, "cached_tokens", None) or 0
+    logger.info(f"🧊 Prompt cache: {cached}/{usage.prompt_tokens} input tokens cached")
+
+
+# ----------------------------------------------------------------------
+# Retry backoff
+# ----------------------------------------------------------------------
+def retry_delay(exc: Exception, attempt: int, base: float = 1.0, cap: float = 30.0) -> float:
+    """
+    Seconds to wait before retry number `attempt` (0-based) after exc. Uses the
+    server's retry-after hint when the API sent one, else jittered exponential
+    backoff, so concurrent workers don't all retry at the same moment.
+    """
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if headers is not None:
+        for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+            try:
+                hint = float(headers.get(name)) * scale
+            except (TypeError, ValueError):
+                continue
+            if 0 <= hint <= 60:
+                return hint + random.uniform(0, 0.25)
+        # No retry-after: wait for whichever per-minute limit ran out to reset
+        for kind in ("requests", "tokens"):
+            if headers.get(f"x-ratelimit-remaining-{kind}") == "0":
+                hint = _reset_seconds(headers.get(f"x-ratelimit-reset-{kind}"))
+                if hint is not None and 0 <= hint <= 60:
+                    return hint + random.uniform(0, 0.25)
+    return random.uniform(0.5, 1.0) * min(cap, base * 2 ** attempt)
+
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+
+
+def _reset_seconds(value):
+    """Seconds in an x-ratelimit-reset-* value such as "1s", "6m0s" or "120ms" (None if unparseable)."""
+    parts = _DURATION_RE.findall(value or "")
+    if not parts or "".join(n + u for n, u in parts) != value.strip():
+        return None
+    return sum(float(n) * _DURATION_UNITS[u] for n, u in parts)
+
+
+# ----------------------------------------------------------------------
+# Rate limiting (stay under the API's requests/tokens per minute)
+# ----------------------------------------------------------------------
+class RateLimitGate:
+    """
+    Tracks the x-ratelimit-* headers of API responses. Once the remaining requests or
+    tokens drop below `headroom` of the limit, new requests wait for that window to
+    reset instead of running into a 429 and its backoff.
+    """
+
+    def __init__(self, headroom: float = 0.05):
+        self.headroom = headroom
+        self._resume_at = 0.0 # time.monotonic() before which nothing new is sent
+        self._lock = threading.Lock()
+
+    def observe(self, headers) -> None:
+        for kind in ("requests", "tokens"):
+            try:
+                limit = float(headers.get(f"x-ratelimit-limit-{kind}"))
+                remaining = float(headers.get(f"x-ratelimit-remaining-{kind}"))
+            except (TypeError, ValueError):
+                continue
+            if remaining < limit * self.headroom:
+                reset = _reset_seconds(headers.get(f"x-ratelimit-reset-{kind}"))
+                if reset is not None and 0 < reset <= 60:
+                    with self._lock:
+                        self._resume_at = max(self._resume_at, time.monotonic() + reset)
+
+    def delay(self) -> float:
+        """Seconds until new requests may go out (0 while there is headroom)."""
+        return max(0.0, self._resume_at - time.monotonic())
+
+    def wait(self) -> None:
+        delay = self.delay()
+        if delay:
+            time.sleep(delay)
+
+    async def wait_async(self) -> None:
+        delay = self.delay()
+        if delay:
+            await asyncio.sleep(delay)
+
+
+@lru_cache(maxsize=1)
+def rate_limit_gate() -> RateLimitGate:
+    """The process-wide gate, fed by every openai_http_client (limits are per account, not per client)."""
+    return RateLimitGate()
+
+
+class AsyncTokenBucket:
+    """Token bucket refilled at `rate` per `period` seconds; acquire() waits until enough tokens are left."""
+
+    def __init__(self, rate: float, period: float = 60.0):
+        self.capacity = float(rate)
+        self.fill_rate = rate / period
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount: float = 1.0) -> None:
+        # A single request larger than the bucket would wait forever; let it drain the bucket instead
+        amount = min(float(amount), self.capacity)
+        # Waiters queue on the lock, so they are served in arrival order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.fill_rate)
+                self._last = now
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return
+                await asyncio.sleep((amount - self._tokens) / self.fill_rate)
+
+    def release(self, amount: float) -> None:
+        """Give back part of an acquire() that turned out too large (e.g. a reply shorter than max_tokens)."""
+        self._tokens = min(self.capacity, self._tokens + max(0.0, float(amount)))
+
+
+# ----------------------------------------------------------------------
+# LLM response cache (content-addressed, one file per response)
+# ----------------------------------------------------------------------
+# Replies sampled above this temperature are meant to vary, so replaying a stored one would hide that
+CACHE_MAX_TEMPERATURE = 0.2
+
+
+def cacheable_temperature(temperature) -> bool:
+    return temperature is None or temperature <= CACHE_MAX_TEMPERATURE
+
+
+class LLMResponseCache:
+    """Store raw LLM responses on disk so unchanged inputs are not re-sent."""
+
+    def __init__(self, cache_dir, enabled: bool = True):
+        self.cache_dir = Path(cache_dir)
+        self.enabled = enabled
+        if enabled:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(*parts) -> str:
+        """Hash everything that affects the response (model, settings, prompt)."""
+        h = hashlib.blake2b(digest_size=16)
+        for part in parts:
+            h.update(str(part).encode("utf-8"))
+            h.update(b"\x00") # Separator so ("ab", "c") and ("a", "bc") differ
+        return h.hexdigest()
+
+    def get(self, key: str):
+        if not self.enabled:
+            return None
+        try:
+            return (self.cache_dir / f"{key}.json").read_text(encoding="utf-8")
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, content: str) -> None:
+        if not self.enabled or not content:
+            return
+        path = self.cache_dir / f"{key}.json"
+        # Write to a unique temp file first so readers never see a partial entry
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_text(content, encoding="utf-8")
+        os.replace(tmp, path)
+
+
+# ----------------------------------------------------------------------
+# Near-duplicate LLM cache (opt-in with RIAS_LLM_CACHE=1)
+# ----------------------------------------------------------------------
+EMBED_MODEL = "text-embedding-3-small"
+EMBED_INPUT_CHARS = 2000
+
+
+def semantic_cache_enabled() -> bool:
+    return os.getenv("RIAS_LLM_CACHE") == "1"
+
+
+class SemanticResponseCache:
+    """
+    Index of LLMResponseCache keys by an embedding of the input document, so a
+    re-run on lightly edited text can reuse the stored reply. Entries only match
+    within one namespace (model, settings and prompt template hashed together).
+    """
+
+    def __init__(self, cache_dir, threshold: float = 0.97):
+        import sqlite3
+
+        self.threshold = threshold
+        self.path = Path(cache_dir) / "semantic.sqlite"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._connect = lambda: sqlite3.connect(self.path, timeout=30)
+        self._lock = threading.Lock()
+        with self._lock, closing(self._connect()) as con, con:
+            con.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, namespace TEXT, vec BLOB)")
+            con.execute("CREATE INDEX IF NOT EXISTS entries_ns ON entries (namespace)")
+
+    @staticmethod
+    def embed_input(document_text: str) -> str:
+        """The part of a document that gets embedded (its opening: title, abstract, introduction)."""
+        return document_text[:EMBED_INPUT_CHARS]
+
+    def lookup(self, namespace: str, vector) -> str:
+        """Cache key of the most similar stored input at or above the threshold, else None."""
+        import numpy as np
+
+        with self._lock, closing(self._connect()) as con, con:
+            rows = con.execute("SELECT key, vec FROM entries WHERE namespace = ?", (namespace,)).fetchall()
+        if not rows:
+            return None
+        query = np.asarray(vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        # Stored vectors are unit length, so the dot product is the cosine similarity
+        matrix = np.frombuffer(b"".join(vec for _, vec in rows), dtype=np.float32).reshape(len(rows), -1)
+        if matrix.shape[1] != query.shape[0]:
+            return None
+        scores = matrix @ query
+        best = int(scores.argmax())
+        return rows[best][0] if scores[best] >= self.threshold else None
+
+    def add(self, namespace: str, key: str, vector) -> None:
+        import numpy as np
+
+        vec = np.asarray(vector, dtype=np.float32)
+        vec /= np.linalg.norm(vec) or 1.0
+        with self._lock, closing(self._connect()) as con, con:
+            con.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", (key, namespace, vec.tobytes()))
+
+
+# ----------------------------------------------------------------------
+# Relevance-based truncation (opt-in with RIAS_RELEVANT_CHUNKS=1)
+# ----------------------------------------------------------------------
+CHUNK_CHARS = 2000 # ~500 tokens per embedded window
+
+
+def relevant_chunks_enabled() -> bool:
+    return os.getenv("RIAS_RELEVANT_CHUNKS") == "1"
+
+
+def split_chunks(text: str, max_chars: int = CHUNK_CHARS) -> list:
+    """Pack blank-line-separated paragraphs into windows of up to max_chars (long paragraphs are cut)."""
+    chunks, current = [], ""
+    for para in text.split("\n\n"):
+        for start in range(0, len(para), max_chars):
+            piece = para[start:start + max_chars]
+            if current and len(current) + 2 + len(piece) > max_chars:
+                chunks.append(current)
+                current = piece
+            else:
+                current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def select_relevant(chunks: list, chunk_vectors, query_vector, budget_chars: int) -> str:
+    """Keep the chunks most similar to the query within budget_chars, joined in document order."""
+    import numpy as np
+
+    matrix = np.asarray(chunk_vectors, dtype=np.float32)
+    query = np.asarray(query_vector, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(query) or 1.0)
+    scores = (matrix @ query) / np.where(norms > 0, norms, 1.0)
+    keep, used = [], 0
+    for i in np.argsort(-scores, kind="stable"):
+        size = len(chunks[i]) + 2
+        if used + size <= budget_chars:
+            keep.append(int(i))
+            used += size
+    return "\n\n".join(chunks[i] for i in sorted(keep))
+
+
+class EmbeddingCache:
+    """Chunk embeddings stored as .npy files, so a document is only embedded once per chunking."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, chunks: list) -> Path:
+        return self.cache_dir / f"{LLMResponseCache.key(EMBED_MODEL, *chunks)}.npy"
+
+    def get(self, chunks: list):
+        import numpy as np
+
+        try:
+            return np.load(self._path(chunks))
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def put(self, chunks: list, vectors) -> None:
+        import numpy as np
+
+        path = self._path(chunks)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, np.asarray(vectors, dtype=np.float32))
+        os.replace(tmp, path)